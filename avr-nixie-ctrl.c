@@ -20,6 +20,7 @@
  * - RPi can remote/in-circuit program the ATmega
  * - RPi can read ADC light sensor
  * - RPi sends time as data for four digits
+ * - ATmega keeps time of day and rolls the time digits between RPi time syncs (version 1.3)
  * - RPi sends dimming control value
  * - ATmega controls/synchronizes multiplexing of digits and dimming
  * - ATmega operates on 3.3v like the RPi
@@ -78,7 +79,7 @@
 #include    <avr/wdt.h>
 #include    <util/delay.h>
 
-#define     VERSION         0x10        // version 1.0
+#include    "avr-nixie-logic.h"
 
 // IO port configuration
 #define     PB_DDR_INIT     0x53        // port data direction
@@ -110,37 +111,7 @@
 
 // General definitions
 #define     PWR_REDUCION    0xeb        // turn off unused peripherals: I2C, timers, UASRT, ADC
-#define     TIMING_TEST     0x01
-#define     HV_ENABLE       0x02
-#define     SECONDS_LED     0x40
-#define     ANODES_OFF      0x0f
-#define     WDOG_EXPIRE     5           // number of seconds for watch-dog expiration
-
-#define     SPI_DUMMY_BYTE  255
-
-#define     SPI_CMD_SET_MIN     1
-#define     SPI_CMD_SET_MINTEN  2
-#define     SPI_CMD_SET_HR      3
-#define     SPI_CMD_SET_HRTEN   4
-#define     SPI_CMD_BRIGHTNESS  5
-#define     SPI_CMD_GET_LIGHT   6
-#define     SPI_CMD_GET_VER     7
-#define     SPI_CMD_WDOG        85
-
-// Sequence count definitions for controller actions
-// The sequence count assumes that the count interval is 200uSec, which is the
-// Nixie Tube recommended blanking period for multiplexed display.
-// Therefore a 1sec action interval is a 5000 count, a blanking interval
-// is a 1 count and so on.
-#define     ONE_SEC_FLASH   2500        // 0.5[sec] 'on' and 0.5-[SEC] 'off'
-#define     FAST_FLASH      625         // fast flash on errors
-#define     ONESEC_INTERVAL 5000
-#define     BLANKING        1           // 200uSec blanking interval
-#define     DIGIT_ON        24          // 4.8mSec 'on' time
-#define     DIGIT_TIME_SLOT (DIGIT_ON+BLANKING) // 'on' time + 200uSec blanking X 4 digits = 20mSec multiplex cycle
-#define     MAX_DIMMING     18          // Maximum dimming time in 200uSec time-slots (must be < DIGIT_ON)
-
-#define     NUM_DIGITS      4           // number of clock digits
+#define     ADC_DECIMATE    0x1f        // average every 32nd ADC conversion, ~1mSec
 
 /****************************************************************************
   type definitions
@@ -155,16 +126,7 @@ void reset(void) __attribute__((naked)) __attribute__((section(".init3")));
 /****************************************************************************
   Globals
 ****************************************************************************/
-volatile uint8_t light_sensor;
-volatile uint8_t spi_data_byte;
-volatile int     watch_dog_counter = 0;
-volatile int     brightness_level = 1;				// Set to '1' as minimum, because '0' turns off high voltage.
-volatile int     dimming_interval = MAX_DIMMING;	// Set to match minimum 'brightness_level'
-
-// This array stores the clock digits, right to left for indexes 0 through 3.
-// The array is read by the timer interrupt and the digits are multiplexed.
-// the array is written to by the SPI interrupt.
-volatile uint8_t digits[NUM_DIGITS] = {0, 0, 0, 0};
+uint16_t         light_sensor_average = 0;  // light sensor moving average, fixed point 8.8
 
 /* ----------------------------------------------------------------------------
  * ioinit()
@@ -214,88 +176,18 @@ void ioinit(void)
 
 /* ----------------------------------------------------------------------------
  * This ISR will trigger when Timer-0 compare reaches the time interval
- * - LED blink rate
- * - High voltage control
- * - Blanking and digit display multiplexing
- * - Adjust blank/display intervals according to 'brightness_level'
+ * every 200uSec, timer logic is in timer_tick()
  *
  */
 ISR(TIMER0_COMPA_vect)
 {
-    static int  seconds_flash_interval = 0;
-    static int  digit_multiplexer = 0;
-    static int  digit_index = 0;
     uint8_t     port_B_temp, port_D_temp;
-    int         flash_rate;
 
     // Read port values
     port_B_temp = PORTB;
     port_D_temp = PORTD;
 
-    /* One second status LED flash period
-     */
-    // High voltage control logic
-	if ( watch_dog_counter >= WDOG_EXPIRE || brightness_level == 0 )
-	{
-	    port_B_temp &= ~HV_ENABLE;
-	}
-	else
-	{
-		port_B_temp |= HV_ENABLE;
-	}
-
-    // If watch dog expired
-    // fast-flash the LED and turn off high voltage
-	if ( watch_dog_counter >= WDOG_EXPIRE )
-    {
-        flash_rate = FAST_FLASH;
-    }
-    else
-    {
-        flash_rate = ONE_SEC_FLASH;
-    }
-
-    seconds_flash_interval++;
-
-    if ( (seconds_flash_interval % flash_rate) == 0 )
-    {
-        port_B_temp ^= SECONDS_LED;
-    }
-
-    if ( (seconds_flash_interval % ONESEC_INTERVAL) == 0 )
-    {
-        seconds_flash_interval = 0;
-        if ( watch_dog_counter < WDOG_EXPIRE )
-            watch_dog_counter++;
-    }
-
-    /* Digit multiplexer timing
-     */
-
-    digit_multiplexer++;
-
-    // Turn off all the anodes at end of digit time slot
-    // but leave whatever digit is set for the BCD decoder.
-    // Roll to next digit if done with one scan of four digits.
-    if ( digit_multiplexer == DIGIT_TIME_SLOT )
-    {
-        port_D_temp &= ANODES_OFF;
-
-        digit_multiplexer = 0;
-        digit_index++;
-        if ( digit_index >= NUM_DIGITS )
-            digit_index = 0;
-    }
-
-    // Display a digit at the end of the blacking period
-    else if ( digit_multiplexer == (BLANKING + dimming_interval) && digits[digit_index] <= 9 )
-    {
-        port_D_temp = digits[digit_index] & 0x0f;
-        port_D_temp |= 0b00010000 << digit_index;
-    }
-
-    // Toggle cycle-test signal
-    port_B_temp ^= TIMING_TEST;
+    timer_tick(&port_B_temp, &port_D_temp);
 
     // Write port values
     PORTB = port_B_temp & PB_DDR_INIT;
@@ -306,114 +198,32 @@ ISR(TIMER0_COMPA_vect)
  * This ISR will trigger when the ADC completes a conversion.
  * Conversions are auto-triggered and this ISR will trigger at 31.25KHz
  * ADC result is left adjusted, so only ADCH needs to be read
+ * Every 32nd conversion is added to a moving average with a time constant
+ * of 256 samples, ~256mSec, which filters out light flicker.
  *
  */
 ISR(ADC_vect)
 {
+    static uint8_t  adc_decimate = 0;
+
+    adc_decimate++;
+    if ( adc_decimate & ADC_DECIMATE )
+        return;
+
     // ADCH read voltage from ADC register
-    light_sensor = ADCH;
+    light_sensor_average = light_sensor_average - (light_sensor_average >> 8) + ADCH;
+    light_sensor = (uint8_t) (light_sensor_average >> 8);
 }
 
 /* ----------------------------------------------------------------------------
  * This ISR will trigger when the SPI interface receives a data byte.
- * The ISR will process 2-byte commands it receives through the SPI interface.
- *
- * The SPI Command interface:
- *
- * | Command byte | Response | Second transmit byte |    Response                   |
- * |--------------|----------|----------------------|-------------------------------|
- * |    1         |  dummy   | Minutes digit        | Current Minutes digit         |
- * |    2         |  dummy   | 10s minutes digit    | Current 10s minutes digit     |
- * |    3         |  dummy   | Hours digit digit    | Current Hours digit digit     |
- * |    4         |  dummy   | 10s hours digit      | Current 10s hours digit       |
- * |    5         |  dummy   | Brightness 0 to 10   | dummy                         |
- * |    6         |  dummy   | dummy                | Ambient light sensor 0 to 255 |
- * |    7         |  dummy   | dummy                | Code rev in 2 nibbles         |
- * |   85         |  dummy   | dummy                |     170                       |
+ * The ISR will process 2-byte commands it receives through the SPI interface,
+ * command logic and the SPI command interface are in spi_byte()
  *
  */
 ISR(SPI_STC_vect)
 {
-    static int byte_count_seq = 0;
-    static int last_command = 0;
-
-    // SPI data input interrupt
-    spi_data_byte = SPDR;
-
-    if ( byte_count_seq == 0 )
-        last_command = spi_data_byte;
-
-    // Process SPI command
-    switch ( last_command )
-    {
-        case SPI_CMD_SET_MIN:
-            if ( byte_count_seq == 0 )
-                SPDR = digits[0];
-            else
-                digits[0] = spi_data_byte;
-            break;
-
-        case SPI_CMD_SET_MINTEN:
-            if ( byte_count_seq == 0 )
-                SPDR = digits[1];
-            else
-                digits[1] = spi_data_byte;
-            break;
-
-        case SPI_CMD_SET_HR:
-            if ( byte_count_seq == 0 )
-                SPDR = digits[2];
-            else
-                digits[2] = spi_data_byte;
-            break;
-
-        case SPI_CMD_SET_HRTEN:
-            if ( byte_count_seq == 0 )
-                SPDR = digits[3];
-            else
-                digits[3] = spi_data_byte;
-            break;
-
-        case SPI_CMD_BRIGHTNESS:
-            if ( byte_count_seq == 0 )
-                SPDR = SPI_DUMMY_BYTE;
-            else
-                brightness_level = spi_data_byte;
-
-            // Convert brightness level to dimming timing intervals
-            // and limit to within digit time slot
-            dimming_interval = (-2 * brightness_level) + 20;
-            if ( dimming_interval > MAX_DIMMING )
-                dimming_interval = MAX_DIMMING;
-            else if ( dimming_interval < 0 )
-                dimming_interval = 0;
-            break;
-
-        case SPI_CMD_GET_LIGHT:
-            if ( byte_count_seq == 0 )
-                SPDR = light_sensor;
-            break;
-
-        case SPI_CMD_GET_VER:
-            if ( byte_count_seq == 0 )
-                SPDR = VERSION;
-            break;
-
-        case SPI_CMD_WDOG:
-            if ( byte_count_seq == 0 )
-            {
-                SPDR = 170;
-                watch_dog_counter = 0;
-            }
-            break;
-
-        default:;
-    }
-
-    // Track command byte sequence
-    byte_count_seq++;
-    if ( byte_count_seq == 2 )
-        byte_count_seq = 0;
+    SPDR = spi_byte(SPDR);
 }
 
 /* ----------------------------------------------------------------------------
@@ -0,0 +1,593 @@
+/*
+ *  avr-nixie-logic.h
+ *
+ * Timer and SPI command logic of the Nixie Tube clock AVR controller.
+ * The logic has no AVR register access: port values and SPI bytes are passed
+ * in and out, so that the same code is compiled into the firmware (avr-nixie-ctrl.c)
+ * and on the host for the ISR benchmark (bench-isr.c).
+ *
+ * The timer logic runs every 200uSec. It uses 8-bit state and down-counters for
+ * its timed events, instead of 16-bit modulo operations that are software divisions on AVR.
+ * State is shared only between ISRs, which do not nest, so it is not volatile.
+ *
+ * From version 1.3 the AVR keeps time of day on the one second tick. After the host
+ * sets the time, the AVR rolls the time digits itself every minute, so the host only
+ * sends digits for effects and re-syncs the time periodically, and the clock keeps
+ * showing the correct time if the host stalls.
+ *
+ */
+
+#ifndef __AVR_NIXIE_LOGIC_H__
+#define __AVR_NIXIE_LOGIC_H__
+
+#include    <stdint.h>
+
+#define     VERSION         0x13        // version 1.3
+
+// Capability bitmap returned by SPI_CMD_GET_CAPS (version 1.1 and up)
+#define     CAP_PACKED_DIGITS   0x01    // two digits per command with SPI_CMD_SET_MINPAIR/SPI_CMD_SET_HRPAIR
+#define     CAP_IMPLICIT_WDOG   0x02    // any complete command resets the watch-dog
+#define     CAP_AVG_SENSOR      0x04    // light sensor reading is a moving average
+#define     CAP_FW_EFFECTS      0x08    // firmware display effects
+#define     CAP_TIMEKEEPING     0x10    // time of day kept by the AVR, SPI_CMD_CLOCK_MODE to SPI_CMD_CLOCK_SEC
+#define     CAPABILITIES        (CAP_PACKED_DIGITS | CAP_IMPLICIT_WDOG | CAP_AVG_SENSOR | CAP_FW_EFFECTS | CAP_TIMEKEEPING)
+
+// Port bits
+#define     TIMING_TEST     0x01
+#define     HV_ENABLE       0x02
+#define     SECONDS_LED     0x40
+#define     ANODES_OFF      0x0f
+#define     WDOG_EXPIRE     5           // number of seconds for watch-dog expiration
+
+#define     SPI_DUMMY_BYTE  255
+
+#define     SPI_CMD_SET_MIN     1
+#define     SPI_CMD_SET_MINTEN  2
+#define     SPI_CMD_SET_HR      3
+#define     SPI_CMD_SET_HRTEN   4
+#define     SPI_CMD_BRIGHTNESS  5
+#define     SPI_CMD_GET_LIGHT   6
+#define     SPI_CMD_GET_VER     7
+#define     SPI_CMD_GET_CAPS    8
+#define     SPI_CMD_SET_MINPAIR 9
+#define     SPI_CMD_SET_HRPAIR  10
+#define     SPI_CMD_SET_FADE    11
+#define     SPI_CMD_SET_RAMP    12
+#define     SPI_CMD_CLOCK_MODE  13
+#define     SPI_CMD_CLOCK_HR    14
+#define     SPI_CMD_CLOCK_MIN   15
+#define     SPI_CMD_CLOCK_SEC   16
+#define     SPI_CMD_WDOG        85
+
+// Sequence count definitions for controller actions
+// The sequence count assumes that the count interval is 200uSec, which is the
+// Nixie Tube recommended blanking period for multiplexed display.
+// Therefore a 1sec action interval is a 5000 count, a blanking interval
+// is a 1 count and so on.
+#define     ONE_SEC_FLASH   2500        // 0.5[sec] 'on' and 0.5-[SEC] 'off'
+#define     FAST_FLASH      625         // fast flash on errors
+#define     ONESEC_INTERVAL 5000
+#define     BLANKING        1           // 200uSec blanking interval
+#define     DIGIT_ON        24          // 4.8mSec 'on' time
+#define     DIGIT_TIME_SLOT (DIGIT_ON+BLANKING) // 'on' time + 200uSec blanking X 4 digits = 20mSec multiplex cycle
+#define     MAX_DIMMING     18          // Maximum dimming time in 200uSec time-slots (must be < DIGIT_ON)
+
+// Flash and one second timing as 8-bit down-counters:
+// a 25mSec flash period, counted in 200uSec ticks, and the number of flash
+// periods in a fast flash and in a half second LED flash
+#define     FLASH_PERIOD    125
+#define     FAST_FLASH_PERIODS  (FAST_FLASH / FLASH_PERIOD)
+#define     HALF_SEC_PERIODS    (ONE_SEC_FLASH / FLASH_PERIOD)
+
+#define     NUM_DIGITS      4           // number of clock digits
+
+#define     FADE_START      255         // crossfade level when a digit changes, all 'on' time is the old digit
+#define     DIGIT_BLANK     10          // blank digit, anodes off
+
+// Clock mode flags
+#define     CLOCK_DISPLAY   0x01        // AVR rolls the time digits every minute
+#define     CLOCK_12HOUR    0x02        // 12-hour time digits with a blank leading hour digit
+#define     CLOCK_SYNCED    0x80        // time was set by the host, read only
+#define     CLOCK_RUNNING   (CLOCK_DISPLAY | CLOCK_SYNCED)
+
+/****************************************************************************
+  Globals
+****************************************************************************/
+volatile uint8_t light_sensor;                  // written by the ADC ISR
+uint8_t          watch_dog_counter = 0;
+uint8_t          brightness_level = 1;          // Set to '1' as minimum, because '0' turns off high voltage.
+uint8_t          dimming_interval = MAX_DIMMING;// Set to match minimum 'brightness_level'
+uint8_t          dimming_target = MAX_DIMMING;  // 'dimming_interval' being ramped to
+uint8_t          ramp_cycles = 0;               // multiplex cycles per dimming step, '0' no ramp
+uint8_t          fade_cycles = 0;               // crossfade time in multiplex cycles, '0' no crossfade
+uint8_t          fade_rate = 0;                 // crossfade level decrement per multiplex cycle
+
+// Time of day kept by the AVR, and the hours and minutes staged by the
+// host until the time is set with the seconds
+uint8_t          clock_flags = 0;
+uint8_t          clock_hours = 0;
+uint8_t          clock_minutes = 0;
+uint8_t          clock_seconds = 0;
+uint8_t          sync_hours = 0;
+uint8_t          sync_minutes = 0;
+
+// One second timing down-counters, restarted when the time is set
+uint8_t          flash_countdown = FLASH_PERIOD;
+uint8_t          half_sec_countdown = HALF_SEC_PERIODS;
+uint8_t          second_half = 0;
+
+// This array stores the clock digits, right to left for indexes 0 through 3.
+// The array is read by the timer interrupt and the digits are multiplexed.
+// the array is written to by the SPI interrupt.
+uint8_t          digits[NUM_DIGITS] = {0, 0, 0, 0};
+
+// Digits being crossfaded out and their crossfade level, from FADE_START to '0'.
+// The crossfade level is the part of the digit's 'on' time that shows the old digit.
+uint8_t          digits_old[NUM_DIGITS] = {0, 0, 0, 0};
+uint8_t          fade_level[NUM_DIGITS] = {0, 0, 0, 0};
+
+/* ----------------------------------------------------------------------------
+ * set_digit()
+ *
+ *  Set a new digit to display, called from the SPI ISR.
+ *  If crossfade is enabled and the digit changed, start a crossfade from the old digit.
+ *
+ */
+static inline void set_digit(uint8_t index, uint8_t digit)
+{
+    if ( fade_rate && digit != digits[index] )
+    {
+        digits_old[index] = digits[index];
+        fade_level[index] = FADE_START;
+    }
+
+    digits[index] = digit;
+}
+
+/* ----------------------------------------------------------------------------
+ * digit_port()
+ *
+ *  Return port D value that displays 'digit' on tube 'index',
+ *  or turns off the anodes if 'digit' is blank.
+ *
+ */
+static inline uint8_t digit_port(uint8_t port_D, uint8_t digit, uint8_t index)
+{
+    if ( digit <= 9 )
+        return (digit & 0x0f) | (0b00010000 << index);
+
+    return port_D & ANODES_OFF;
+}
+
+/* ----------------------------------------------------------------------------
+ * transitions()
+ *
+ *  Advance digit crossfades and the brightness ramp, called once per multiplex cycle.
+ *
+ */
+static inline void transitions(void)
+{
+    static uint8_t  ramp_counter = 0;
+    uint8_t         i;
+
+    for ( i = 0; i < NUM_DIGITS; i++ )
+    {
+        if ( fade_level[i] > fade_rate )
+            fade_level[i] -= fade_rate;
+        else
+            fade_level[i] = 0;
+    }
+
+    if ( dimming_interval == dimming_target )
+        return;
+
+    ramp_counter++;
+    if ( ramp_counter < ramp_cycles )
+        return;
+
+    ramp_counter = 0;
+    if ( dimming_interval < dimming_target )
+        dimming_interval++;
+    else
+        dimming_interval--;
+}
+
+/* ----------------------------------------------------------------------------
+ * set_digit_pair()
+ *
+ *  Set two digits from a value between 0 and 99, the tens digit is blank
+ *  if it is '0' and 'blank_zero' is set.
+ *  Tens are counted by subtraction, there is no hardware division on AVR.
+ *
+ */
+static inline void set_digit_pair(uint8_t index, uint8_t value, uint8_t blank_zero)
+{
+    uint8_t tens = 0;
+
+    while ( value >= 10 )
+    {
+        value -= 10;
+        tens++;
+    }
+
+    set_digit(index, value);
+    set_digit(index + 1, (tens == 0 && blank_zero) ? DIGIT_BLANK : tens);
+}
+
+/* ----------------------------------------------------------------------------
+ * clock_digits()
+ *
+ *  Set the time digits from the clock, in 12 or 24 hour format.
+ *
+ */
+static inline void clock_digits(void)
+{
+    uint8_t hour = clock_hours;
+
+    if ( clock_flags & CLOCK_12HOUR )
+    {
+        if ( hour > 12 )
+            hour -= 12;
+        else if ( hour == 0 )
+            hour = 12;
+    }
+
+    set_digit_pair(0, clock_minutes, 0);
+    set_digit_pair(2, hour, clock_flags & CLOCK_12HOUR);
+}
+
+/* ----------------------------------------------------------------------------
+ * clock_tick()
+ *
+ *  Advance the clock by one second, called from the timer logic.
+ *  Roll the time digits every minute if the clock was set and its display is on.
+ *
+ */
+static inline void clock_tick(void)
+{
+    if ( ++clock_seconds < 60 )
+        return;
+
+    clock_seconds = 0;
+    if ( ++clock_minutes == 60 )
+    {
+        clock_minutes = 0;
+        if ( ++clock_hours == 24 )
+            clock_hours = 0;
+    }
+
+    if ( (clock_flags & CLOCK_RUNNING) == CLOCK_RUNNING )
+        clock_digits();
+}
+
+/* ----------------------------------------------------------------------------
+ * clock_sync()
+ *
+ *  Set the clock to the staged hours and minutes and to 'seconds', called from
+ *  the SPI logic. The one second timing restarts, so that the next second starts
+ *  one second after the command.
+ *
+ */
+static inline void clock_sync(uint8_t seconds)
+{
+    clock_hours = sync_hours;
+    clock_minutes = sync_minutes;
+    clock_seconds = seconds;
+    clock_flags |= CLOCK_SYNCED;
+
+    flash_countdown = FLASH_PERIOD;
+    half_sec_countdown = HALF_SEC_PERIODS;
+    second_half = 0;
+
+    if ( clock_flags & CLOCK_DISPLAY )
+        clock_digits();
+}
+
+/* ----------------------------------------------------------------------------
+ * timer_tick()
+ *
+ *  Timer logic, called every 200uSec with the port B and D values to update.
+ *  - LED blink rate
+ *  - High voltage control
+ *  - Blanking and digit display multiplexing
+ *  - Adjust blank/display intervals according to 'brightness_level'
+ *  - Crossfade changed digits by splitting the digit's 'on' time between
+ *    the old and new digit, and ramp brightness changes
+ *  - Time of day clock
+ *
+ */
+static inline void timer_tick(uint8_t *port_B, uint8_t *port_D)
+{
+    static uint8_t  fast_flash_countdown = FAST_FLASH_PERIODS;
+    static uint8_t  digit_multiplexer = 0;
+    static uint8_t  digit_index = 0;
+    static uint8_t  digit_on_time = BLANKING + MAX_DIMMING;
+    static uint8_t  digit_switch_time = BLANKING + MAX_DIMMING;
+    uint8_t         port_B_temp, port_D_temp;
+    uint8_t         expired;
+
+    port_B_temp = *port_B;
+    port_D_temp = *port_D;
+
+    expired = (watch_dog_counter >= WDOG_EXPIRE);
+
+    // High voltage control logic, the display stays on after a watch-dog
+    // expiry while the AVR keeps time and rolls the time digits
+    if ( (expired && (clock_flags & CLOCK_RUNNING) != CLOCK_RUNNING) || brightness_level == 0 )
+        port_B_temp &= ~HV_ENABLE;
+    else
+        port_B_temp |= HV_ENABLE;
+
+    /* LED flash and one second period.
+     * If watch dog expired fast-flash the LED, otherwise flash
+     * once a second and count watch-dog seconds. Advance the clock every second.
+     */
+    if ( --flash_countdown == 0 )
+    {
+        flash_countdown = FLASH_PERIOD;
+
+        if ( --fast_flash_countdown == 0 )
+        {
+            fast_flash_countdown = FAST_FLASH_PERIODS;
+            if ( expired )
+                port_B_temp ^= SECONDS_LED;
+        }
+
+        if ( --half_sec_countdown == 0 )
+        {
+            half_sec_countdown = HALF_SEC_PERIODS;
+            if ( !expired )
+                port_B_temp ^= SECONDS_LED;
+
+            second_half ^= 1;
+            if ( second_half == 0 )
+            {
+                clock_tick();
+                if ( !expired )
+                    watch_dog_counter++;
+            }
+        }
+    }
+
+    /* Digit multiplexer timing
+     */
+
+    digit_multiplexer++;
+
+    // Turn off all the anodes at end of digit time slot
+    // but leave whatever digit is set for the BCD decoder.
+    // Roll to next digit if done with one scan of four digits.
+    if ( digit_multiplexer == DIGIT_TIME_SLOT )
+    {
+        port_D_temp &= ANODES_OFF;
+
+        digit_multiplexer = 0;
+        digit_index++;
+        if ( digit_index >= NUM_DIGITS )
+        {
+            digit_index = 0;
+            transitions();
+        }
+
+        // Schedule the next digit's 'on' time, and the time to switch from the old
+        // to the new digit as a part of the 'on' time set by the crossfade level
+        digit_on_time = BLANKING + dimming_interval;
+        digit_switch_time = digit_on_time +
+                            (uint8_t)(((uint16_t) fade_level[digit_index] * (DIGIT_TIME_SLOT - digit_on_time)) >> 8);
+    }
+
+    // Display a digit at the end of the blacking period,
+    // the old digit first if the digit is crossfading
+    else if ( digit_multiplexer == digit_on_time )
+    {
+        if ( digit_switch_time > digit_on_time )
+            port_D_temp = digit_port(port_D_temp, digits_old[digit_index], digit_index);
+        else
+            port_D_temp = digit_port(port_D_temp, digits[digit_index], digit_index);
+    }
+
+    // Switch a crossfading digit from the old to the new digit
+    else if ( digit_multiplexer == digit_switch_time )
+    {
+        port_D_temp = digit_port(port_D_temp, digits[digit_index], digit_index);
+    }
+
+    // Toggle cycle-test signal
+    port_B_temp ^= TIMING_TEST;
+
+    *port_B = port_B_temp;
+    *port_D = port_D_temp;
+}
+
+/* ----------------------------------------------------------------------------
+ * spi_byte()
+ *
+ *  SPI command logic, called with every byte received through the SPI interface.
+ *  Return the byte to shift out with the next transfer, the received byte
+ *  if the command has no reply.
+ *
+ * The SPI Command interface:
+ *
+ * | Command byte | Response | Second transmit byte |    Response                   |
+ * |--------------|----------|----------------------|-------------------------------|
+ * |    1         |  dummy   | Minutes digit        | Current Minutes digit         |
+ * |    2         |  dummy   | 10s minutes digit    | Current 10s minutes digit     |
+ * |    3         |  dummy   | Hours digit digit    | Current Hours digit digit     |
+ * |    4         |  dummy   | 10s hours digit      | Current 10s hours digit       |
+ * |    5         |  dummy   | Brightness 0 to 10   | dummy                         |
+ * |    6         |  dummy   | dummy                | Ambient light sensor 0 to 255 |
+ * |    7         |  dummy   | dummy                | Code rev in 2 nibbles         |
+ * |    8         |  dummy   | dummy                | Capability bitmap             |
+ * |    9         |  dummy   | 10s min/min nibbles  | Current 10s min/min nibbles   |
+ * |   10         |  dummy   | 10s hr/hr nibbles    | Current 10s hr/hr nibbles     |
+ * |   11         |  dummy   | Crossfade cycles     | Current crossfade cycles      |
+ * |   12         |  dummy   | Ramp cycles          | Current ramp cycles           |
+ * |   13         |  dummy   | Clock mode flags     | Current clock mode flags      |
+ * |   14         |  dummy   | Hours 0 to 23        | Current clock hours           |
+ * |   15         |  dummy   | Minutes 0 to 59      | Current clock minutes         |
+ * |   16         |  dummy   | Seconds 0 to 59      | Current clock seconds         |
+ * |   85         |  dummy   | dummy                |     170                       |
+ *
+ * Any complete command resets the watch-dog, not only command 85.
+ * Crossfade time is in 20mSec multiplex cycles, ramp time is multiplex cycles
+ * per dimming step, '0' turns off crossfade or ramp.
+ * The time is set by commands 14, 15 and then 16: hours and minutes are held until
+ * the seconds are sent, and the new second starts with command 16. A dummy byte
+ * sent to commands 13 to 16 only reads the current value.
+ *
+ */
+static inline uint8_t spi_byte(uint8_t spi_data_byte)
+{
+    static uint8_t byte_count_seq = 0;
+    static uint8_t last_command = 0;
+    uint8_t    reply = spi_data_byte;
+    uint8_t    valid_command = 1;
+    uint8_t    i;
+
+    if ( byte_count_seq == 0 )
+        last_command = spi_data_byte;
+
+    // Process SPI command
+    switch ( last_command )
+    {
+        case SPI_CMD_SET_MIN:
+        case SPI_CMD_SET_MINTEN:
+        case SPI_CMD_SET_HR:
+        case SPI_CMD_SET_HRTEN:
+            if ( byte_count_seq == 0 )
+                reply = digits[last_command - SPI_CMD_SET_MIN];
+            else
+                set_digit(last_command - SPI_CMD_SET_MIN, spi_data_byte);
+            break;
+
+        case SPI_CMD_BRIGHTNESS:
+            if ( byte_count_seq == 0 )
+                reply = SPI_DUMMY_BYTE;
+            else
+                brightness_level = spi_data_byte;
+
+            // Convert brightness level to dimming timing intervals
+            // and limit to within digit time slot
+            if ( brightness_level >= 10 )
+                dimming_target = 0;
+            else if ( brightness_level == 0 )
+                dimming_target = MAX_DIMMING;
+            else
+                dimming_target = 20 - 2 * brightness_level;
+
+            // Without a ramp the new brightness applies immediately
+            if ( ramp_cycles == 0 )
+                dimming_interval = dimming_target;
+            break;
+
+        case SPI_CMD_GET_LIGHT:
+            if ( byte_count_seq == 0 )
+                reply = light_sensor;
+            break;
+
+        case SPI_CMD_GET_VER:
+            if ( byte_count_seq == 0 )
+                reply = VERSION;
+            break;
+
+        case SPI_CMD_GET_CAPS:
+            if ( byte_count_seq == 0 )
+                reply = CAPABILITIES;
+            break;
+
+        case SPI_CMD_SET_MINPAIR:
+            if ( byte_count_seq == 0 )
+                reply = (digits[1] << 4) | (digits[0] & 0x0f);
+            else
+            {
+                set_digit(0, spi_data_byte & 0x0f);
+                set_digit(1, spi_data_byte >> 4);
+            }
+            break;
+
+        case SPI_CMD_SET_HRPAIR:
+            if ( byte_count_seq == 0 )
+                reply = (digits[3] << 4) | (digits[2] & 0x0f);
+            else
+            {
+                set_digit(2, spi_data_byte & 0x0f);
+                set_digit(3, spi_data_byte >> 4);
+            }
+            break;
+
+        case SPI_CMD_SET_FADE:
+            if ( byte_count_seq == 0 )
+                reply = fade_cycles;
+            else
+            {
+                fade_cycles = spi_data_byte;
+                if ( fade_cycles == 0 )
+                {
+                    // End crossfades in progress, they do not advance without a fade rate
+                    fade_rate = 0;
+                    for ( i = 0; i < NUM_DIGITS; i++ )
+                        fade_level[i] = 0;
+                }
+                else
+                    fade_rate = FADE_START / fade_cycles;
+            }
+            break;
+
+        case SPI_CMD_SET_RAMP:
+            if ( byte_count_seq == 0 )
+                reply = ramp_cycles;
+            else
+                ramp_cycles = spi_data_byte;
+            break;
+
+        case SPI_CMD_CLOCK_MODE:
+            if ( byte_count_seq == 0 )
+                reply = clock_flags;
+            else if ( spi_data_byte != SPI_DUMMY_BYTE )
+                clock_flags = (clock_flags & CLOCK_SYNCED) | (spi_data_byte & (CLOCK_DISPLAY | CLOCK_12HOUR));
+            break;
+
+        case SPI_CMD_CLOCK_HR:
+            if ( byte_count_seq == 0 )
+                reply = clock_hours;
+            else if ( spi_data_byte < 24 )
+                sync_hours = spi_data_byte;
+            break;
+
+        case SPI_CMD_CLOCK_MIN:
+            if ( byte_count_seq == 0 )
+                reply = clock_minutes;
+            else if ( spi_data_byte < 60 )
+                sync_minutes = spi_data_byte;
+            break;
+
+        case SPI_CMD_CLOCK_SEC:
+            if ( byte_count_seq == 0 )
+                reply = clock_seconds;
+            else if ( spi_data_byte < 60 )
+                clock_sync(spi_data_byte);
+            break;
+
+        case SPI_CMD_WDOG:
+            if ( byte_count_seq == 0 )
+            {
+                reply = 170;
+                watch_dog_counter = 0;
+            }
+            break;
+
+        default:
+            valid_command = 0;
+    }
+
+    // Implicit watch-dog 'keep alive'
+    if ( valid_command && byte_count_seq == 1 )
+        watch_dog_counter = 0;
+
+    // Track command byte sequence
+    byte_count_seq ^= 1;
+
+    return reply;
+}
+
+#endif /* __AVR_NIXIE_LOGIC_H__ */
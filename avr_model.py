@@ -0,0 +1,419 @@
+#
+# avr_model.py
+#
+#   Simulated AVR controller for Nixie Tube clock.
+#   A behavioral model of the avr-nixie-ctrl.c firmware SPI command interface,
+#   watch-dog and high voltage control, used to replay recorded SPI traffic
+#   and to run the clock software without hardware.
+#   The model follows the firmware's byte level framing: SPI transfers are full duplex,
+#   the reply to a byte is whatever the previous byte's ISR left in SPDR.
+#   Firmware versions before 1.1, without capability negotiation, version 1.1,
+#   without firmware display effects, and version 1.2, without time keeping, can be modeled.
+#   Digit crossfade and brightness ramp are modeled per multiplex cycle.
+#   The AVR's oscillator error can be modeled, it drifts the AVR clock from the host clock.
+#   SimulatedBcm2835 connects the model to the clock module in place of the bcm2835
+#   library, with SPI byte timing in virtual time.
+#
+
+SPI_CMD_SET_MIN = 1
+SPI_CMD_SET_MINTEN = 2
+SPI_CMD_SET_HR = 3
+SPI_CMD_SET_HRTEN = 4
+SPI_CMD_BRIGHTNESS = 5
+SPI_CMD_GET_LIGHT = 6
+SPI_CMD_GET_VER = 7
+SPI_CMD_GET_CAPS = 8
+SPI_CMD_SET_MINPAIR = 9
+SPI_CMD_SET_HRPAIR = 10
+SPI_CMD_SET_FADE = 11
+SPI_CMD_SET_RAMP = 12
+SPI_CMD_CLOCK_MODE = 13
+SPI_CMD_CLOCK_HR = 14
+SPI_CMD_CLOCK_MIN = 15
+SPI_CMD_CLOCK_SEC = 16
+SPI_CMD_WDOG = 85
+
+VERSION = 0x13
+CAPS_VERSION = 0x11
+FW_EFFECTS_VERSION = 0x12
+TIMEKEEPING_VERSION = 0x13
+CAP_PACKED_DIGITS = 0x01
+CAP_IMPLICIT_WDOG = 0x02
+CAP_AVG_SENSOR = 0x04
+CAP_FW_EFFECTS = 0x08
+CAP_TIMEKEEPING = 0x10
+CAPABILITIES = CAP_PACKED_DIGITS | CAP_IMPLICIT_WDOG | CAP_AVG_SENSOR | CAP_FW_EFFECTS | CAP_TIMEKEEPING
+CLOCK_DISPLAY = 0x01
+CLOCK_12HOUR = 0x02
+CLOCK_SYNCED = 0x80
+CLOCK_RUNNING = CLOCK_DISPLAY | CLOCK_SYNCED
+DIGIT_BLANK = 10
+SPI_DUMMY_BYTE = 255
+WATCH_DOG_REPLY = 170
+WDOG_EXPIRE = 5
+SPI_BYTE_TIME = 8 * 65536 / 250.0e6     # SPI byte time at BCM2835_SPI_CLOCK_DIVIDER_65536
+MAX_DIMMING = 18
+NUM_DIGITS = 4
+MULTIPLEX_CYCLE = 0.02                  # Four digit multiplex cycle in seconds
+FADE_START = 255
+
+class AvrModel:
+    """Behavioral model of the AVR controller firmware."""
+
+    def __init__(self, light_sensor=128, version=VERSION, drift_ppm=0.0):
+        """
+        Initialize the model of firmware 'version' to its power-on state, its timer
+        runs 'drift_ppm' parts per million fast, or slow if negative.
+        """
+
+        self.light_sensor = light_sensor
+        self.version = version
+        self.clock_rate = 1.0 + drift_ppm * 1e-6
+        self.watch_dog_expiries = 0
+        self.reset()
+
+    def reset(self):
+        """AVR hardware reset."""
+
+        self.digits = [0] * NUM_DIGITS
+        self.brightness_level = 1
+        self.dimming_interval = MAX_DIMMING
+        self.dimming_target = MAX_DIMMING
+        self.ramp_cycles = 0
+        self.ramp_counter = 0
+        self.fade_cycles = 0
+        self.fade_rate = 0
+        self.digits_old = [0] * NUM_DIGITS
+        self.fade_level = [0] * NUM_DIGITS
+        self.watch_dog_counter = 0
+        self.byte_count_seq = 0
+        self.last_command = 0
+        self.spdr = SPI_DUMMY_BYTE
+        self.time_in_second = 0.0
+        self.time_in_cycle = 0.0
+        self.clock_flags = 0
+        self.clock_time = [0, 0, 0]         # hours, minutes, seconds
+        self.sync_time = [0, 0]             # staged hours and minutes
+
+    def capabilities(self):
+        """Return the capability bitmap of the modeled firmware version."""
+
+        caps = CAPABILITIES
+        if self.version < FW_EFFECTS_VERSION:
+            caps &= ~CAP_FW_EFFECTS
+        if self.version < TIMEKEEPING_VERSION:
+            caps &= ~CAP_TIMEKEEPING
+        return caps
+
+    def tick(self, seconds):
+        """
+        Advance the timer model by 'seconds' of host time; the watch-dog and the clock
+        count whole seconds, crossfades and the brightness ramp advance by whole multiplex cycles.
+        """
+
+        seconds *= self.clock_rate
+
+        self.time_in_cycle += seconds
+        if self.time_in_cycle >= MULTIPLEX_CYCLE:
+            cycles = int(self.time_in_cycle / MULTIPLEX_CYCLE)
+            self.time_in_cycle -= cycles * MULTIPLEX_CYCLE
+            self._transitions(cycles)
+
+        self.time_in_second += seconds
+        while self.time_in_second >= 1.0:
+            self.time_in_second -= 1.0
+            self._clock_tick()
+            if self.watch_dog_counter < WDOG_EXPIRE:
+                self.watch_dog_counter += 1
+                if self.watch_dog_counter == WDOG_EXPIRE:
+                    self.watch_dog_expiries += 1
+
+    def transfer(self, byte):
+        """Full duplex transfer of one SPI byte, returns the byte shifted out by the AVR."""
+
+        reply = self.spdr
+        self.spdr = byte
+        self._spi_isr(byte)
+        return reply
+
+    def high_voltage(self):
+        """Return True if the tube high voltage is enabled."""
+
+        running = (self.clock_flags & CLOCK_RUNNING) == CLOCK_RUNNING
+        return (self.watch_dog_counter < WDOG_EXPIRE or running) and self.brightness_level != 0
+
+    def clock(self):
+        """Return the AVR clock time as (hours, minutes, seconds)."""
+
+        return tuple(self.clock_time)
+
+    def display(self):
+        """Return displayed digits in clock order, tens of hours first; '10' is a blank digit."""
+
+        if not self.high_voltage():
+            return [10] * NUM_DIGITS
+
+        return [d if d <= 9 else 10 for d in reversed(self.digits)]
+
+    def fading(self):
+        """Return True if a digit crossfade or brightness ramp is in progress."""
+
+        return max(self.fade_level) > 0 or self.dimming_interval != self.dimming_target
+
+    def _set_digit(self, index, digit):
+        """Model of set_digit(), starts a crossfade if enabled and the digit changed."""
+
+        if self.fade_rate and digit != self.digits[index]:
+            self.digits_old[index] = self.digits[index]
+            self.fade_level[index] = FADE_START
+
+        self.digits[index] = digit
+
+    def _clock_digits(self):
+        """Model of clock_digits(), sets the time digits in 12 or 24 hour format."""
+
+        hours, minutes, seconds = self.clock_time
+        if self.clock_flags & CLOCK_12HOUR:
+            if hours > 12:
+                hours -= 12
+            elif hours == 0:
+                hours = 12
+
+        self._set_digit(0, minutes % 10)
+        self._set_digit(1, minutes // 10)
+        self._set_digit(2, hours % 10)
+        self._set_digit(3, DIGIT_BLANK if hours < 10 and self.clock_flags & CLOCK_12HOUR else hours // 10)
+
+    def _clock_tick(self):
+        """Model of clock_tick(), advances the clock by one second."""
+
+        hours, minutes, seconds = self.clock_time
+        seconds += 1
+        if seconds < 60:
+            self.clock_time[2] = seconds
+            return
+
+        minutes += 1
+        if minutes == 60:
+            minutes = 0
+            hours = (hours + 1) % 24
+        self.clock_time = [hours, minutes, 0]
+
+        if (self.clock_flags & CLOCK_RUNNING) == CLOCK_RUNNING:
+            self._clock_digits()
+
+    def _clock_sync(self, seconds):
+        """Model of clock_sync(), sets the clock and restarts the second."""
+
+        self.clock_time = self.sync_time + [seconds]
+        self.clock_flags |= CLOCK_SYNCED
+        self.time_in_second = 0.0
+
+        if self.clock_flags & CLOCK_DISPLAY:
+            self._clock_digits()
+
+    def _transitions(self, cycles):
+        """Model of transitions() called 'cycles' times."""
+
+        self.fade_level = [max(level - cycles * self.fade_rate, 0) for level in self.fade_level]
+
+        if self.dimming_interval == self.dimming_target:
+            return
+
+        self.ramp_counter += cycles
+        steps = self.ramp_counter // max(self.ramp_cycles, 1)
+        self.ramp_counter -= steps * max(self.ramp_cycles, 1)
+        if steps >= abs(self.dimming_target - self.dimming_interval):
+            self.dimming_interval = self.dimming_target
+            self.ramp_counter = 0
+        elif self.dimming_interval < self.dimming_target:
+            self.dimming_interval += steps
+        else:
+            self.dimming_interval -= steps
+
+    def _spi_isr(self, spi_data_byte):
+        """Model of ISR(SPI_STC_vect)."""
+
+        if self.byte_count_seq == 0:
+            self.last_command = spi_data_byte
+
+        valid_command = True
+
+        if self.last_command >= SPI_CMD_SET_MIN and self.last_command <= SPI_CMD_SET_HRTEN:
+            index = self.last_command - SPI_CMD_SET_MIN
+            if self.byte_count_seq == 0:
+                self.spdr = self.digits[index]
+            else:
+                self._set_digit(index, spi_data_byte)
+
+        elif self.last_command == SPI_CMD_BRIGHTNESS:
+            if self.byte_count_seq == 0:
+                self.spdr = SPI_DUMMY_BYTE
+            else:
+                self.brightness_level = spi_data_byte
+            self.dimming_target = min(max((-2 * self.brightness_level) + 20, 0), MAX_DIMMING)
+            if self.ramp_cycles == 0:
+                self.dimming_interval = self.dimming_target
+
+        elif self.last_command == SPI_CMD_GET_LIGHT:
+            if self.byte_count_seq == 0:
+                self.spdr = self.light_sensor
+
+        elif self.last_command == SPI_CMD_GET_VER:
+            if self.byte_count_seq == 0:
+                self.spdr = self.version
+
+        elif self.last_command == SPI_CMD_WDOG:
+            if self.byte_count_seq == 0:
+                self.spdr = WATCH_DOG_REPLY
+                self.watch_dog_counter = 0
+
+        elif self.version < CAPS_VERSION:
+            valid_command = False
+
+        elif self.last_command == SPI_CMD_GET_CAPS:
+            if self.byte_count_seq == 0:
+                self.spdr = self.capabilities()
+
+        elif self.last_command == SPI_CMD_SET_MINPAIR or self.last_command == SPI_CMD_SET_HRPAIR:
+            index = 2 * (self.last_command - SPI_CMD_SET_MINPAIR)
+            if self.byte_count_seq == 0:
+                self.spdr = (self.digits[index+1] << 4) | (self.digits[index] & 0x0f)
+            else:
+                self._set_digit(index, spi_data_byte & 0x0f)
+                self._set_digit(index+1, spi_data_byte >> 4)
+
+        elif self.version < FW_EFFECTS_VERSION:
+            valid_command = False
+
+        elif self.last_command == SPI_CMD_SET_FADE:
+            if self.byte_count_seq == 0:
+                self.spdr = self.fade_cycles
+            else:
+                self.fade_cycles = spi_data_byte
+                self.fade_rate = FADE_START // spi_data_byte if spi_data_byte else 0
+                if self.fade_rate == 0:
+                    self.fade_level = [0] * NUM_DIGITS
+
+        elif self.last_command == SPI_CMD_SET_RAMP:
+            if self.byte_count_seq == 0:
+                self.spdr = self.ramp_cycles
+            else:
+                self.ramp_cycles = spi_data_byte
+
+        elif self.version < TIMEKEEPING_VERSION:
+            valid_command = False
+
+        elif self.last_command == SPI_CMD_CLOCK_MODE:
+            if self.byte_count_seq == 0:
+                self.spdr = self.clock_flags
+            elif spi_data_byte != SPI_DUMMY_BYTE:
+                self.clock_flags = (self.clock_flags & CLOCK_SYNCED) | (spi_data_byte & (CLOCK_DISPLAY | CLOCK_12HOUR))
+
+        elif self.last_command >= SPI_CMD_CLOCK_HR and self.last_command <= SPI_CMD_CLOCK_SEC:
+            index = self.last_command - SPI_CMD_CLOCK_HR
+            if self.byte_count_seq == 0:
+                self.spdr = self.clock_time[index]
+            elif spi_data_byte < (24, 60, 60)[index]:
+                if self.last_command == SPI_CMD_CLOCK_SEC:
+                    self._clock_sync(spi_data_byte)
+                else:
+                    self.sync_time[index] = spi_data_byte
+
+        else:
+            valid_command = False
+
+        # Implicit watch-dog 'keep alive'
+        if valid_command and self.byte_count_seq == 1 and self.version >= CAPS_VERSION:
+            self.watch_dog_counter = 0
+
+        self.byte_count_seq += 1
+        if self.byte_count_seq == 2:
+            self.byte_count_seq = 0
+
+class SimulatedBcm2835:
+    """The subset of the bcm2835 library used by the clock module, connected to an AvrModel."""
+
+    RPI_GPIO_P1_24 = 8
+    BCM2835_GPIO_FSEL_OUTP = 1
+    BCM2835_SPI_BIT_ORDER_MSBFIRST = 1
+    BCM2835_SPI_MODE0 = 0
+    BCM2835_SPI_CLOCK_DIVIDER_65536 = 0
+    BCM2835_SPI_CS0 = 0
+    BCM2835_SPI_CS1 = 1
+    LOW = 0
+
+    def __init__(self, model, time_source):
+        """
+        Connect to 'model', SPI transfers and the model's timer advance 'time_source' time.
+        An 'on_transfer(bus)' function can be set to monitor the model after every SPI byte.
+        """
+
+        self.model = model
+        self.time_source = time_source
+        self.last_time = time_source.time()
+        self.bytes_transferred = 0
+        self.commands = {}
+        self.on_transfer = None
+
+    def sync(self):
+        """Advance the model's timer to the current time."""
+
+        time_now = self.time_source.time()
+        self.model.tick(max(time_now - self.last_time, 0.0))
+        self.last_time = time_now
+
+    def bcm2835_spi_transfer(self, byte):
+        """Transfer one byte to the model, taking one SPI byte time."""
+
+        self.time_source.sleep(SPI_BYTE_TIME)
+        self.sync()
+        self.bytes_transferred += 1
+        if self.model.byte_count_seq == 0:
+            self.commands[byte] = self.commands.get(byte, 0) + 1
+
+        reply = self.model.transfer(byte)
+        if self.on_transfer:
+            self.on_transfer(self)
+
+        return reply
+
+    def bcm2835_gpio_clr(self, pin):
+        """GPIO8 low resets the AVR."""
+
+        if pin == self.RPI_GPIO_P1_24:
+            self.sync()
+            self.model.reset()
+
+    def bcm2835_init(self):
+        return 1
+
+    def bcm2835_close(self):
+        return 1
+
+    def bcm2835_gpio_fsel(self, pin, mode):
+        pass
+
+    def bcm2835_gpio_set(self, pin):
+        pass
+
+    def bcm2835_spi_begin(self):
+        return 1
+
+    def bcm2835_spi_end(self):
+        pass
+
+    def bcm2835_spi_setBitOrder(self, order):
+        pass
+
+    def bcm2835_spi_setDataMode(self, mode):
+        pass
+
+    def bcm2835_spi_setClockDivider(self, divider):
+        pass
+
+    def bcm2835_spi_chipSelect(self, cs):
+        pass
+
+    def bcm2835_spi_setChipSelectPolarity(self, cs, active):
+        pass
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+###############################################################################
+#
+# bench-footprint.py
+#
+#   Start-up time and memory footprint benchmark.
+#   Starts the clock in a new Python process, the same way as nixie_clock.py,
+#   against the simulated AVR (avr_model.py) with real SPI byte timing, and
+#   measures the time from process start to the first displayed frame and the
+#   process' maximum resident memory.
+#   The benchmark fails, with exit code 1, if a result is over its budget.
+#   Default budgets have ~50% margin over a desktop measurement with Python 2.7
+#   (160mSec, most of it the AVR reset settle time and SPI bytes, and 8.5MB),
+#   pass Pi Zero W budgets on the command line when running on the clock.
+#
+#   usage: bench-footprint.py [--runs N] [--startup-budget MSEC] [--rss-budget KB]
+#
+###############################################################################
+
+import os
+import sys
+import time
+import resource
+import subprocess
+
+STARTUP_BUDGET = 250.0      # Cold start to first frame in mSec
+RSS_BUDGET = 12288          # Maximum resident memory in kB
+RUNS = 5
+
+SPI_FRAME_COMMANDS = (1, 2, 3, 4, 5, 9, 10)    # Digit and brightness commands, only brightness is sent in the display 'off' period
+
+def main():
+    """Run the benchmark child process several times and check results against budgets."""
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child()
+        return
+
+    runs = RUNS
+    startup_budget = STARTUP_BUDGET
+    rss_budget = RSS_BUDGET
+    args = sys.argv[1:]
+    while args:
+        if args[0] == '--runs':
+            runs = int(args[1])
+        elif args[0] == '--startup-budget':
+            startup_budget = float(args[1])
+        elif args[0] == '--rss-budget':
+            rss_budget = int(args[1])
+        else:
+            print('usage: bench-footprint.py [--runs N] [--startup-budget MSEC] [--rss-budget KB]')
+            sys.exit(1)
+        args = args[2:]
+
+    startup = []
+    rss = []
+    for run in range(0,runs):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child'])
+        first_frame, max_rss = output.split()
+        startup.append((float(first_frame) - start) * 1000.0)
+        rss.append(int(max_rss))
+
+    startup.sort()
+    median_startup = startup[len(startup) // 2]
+    print('cold start to first frame: median {:.1f}[mSec] min {:.1f} max {:.1f}, budget {:.1f}[mSec]'.format(
+          median_startup, startup[0], startup[-1], startup_budget))
+    print('maximum resident memory: {}[kB], budget {}[kB]'.format(max(rss), rss_budget))
+
+    if median_startup > startup_budget or max(rss) > rss_budget:
+        print('FAIL: over budget')
+        sys.exit(1)
+
+    print('PASS')
+
+def child():
+    """Start the clock like nixie_clock.py and print the first frame time and maximum RSS."""
+
+    import avr_model
+    import clock
+    import dispatcher as dsp
+    from configuration import get_clock_config
+
+    bus = avr_model.SimulatedBcm2835(avr_model.AvrModel(), time)
+    clock.soc = bus
+
+    parameter_init = {'config_file_last_mod':0.0, 'config_change':'no', 'wear_file':os.devnull}
+    get_clock_config(parameter_init)
+    parameter_init['event_log'] = 'no'
+    clock.initialize(parameter_init)
+
+    clock_driver = dsp.Dispatcher(parameter_init)
+    clock_driver.register('watchdog', clock.watchdog, 4)
+    clock_driver.register('time_display', clock.time_display, 1)
+    clock_driver.register('configuration', get_clock_config, 60)
+    clock_driver.register('cathode_wear', clock.wear_persist, 900)
+    clock_driver.register('spi_recorder', clock.spi_record, 5)
+    clock_driver.register('event_log', clock.log_events, 5)
+    clock_driver.register('mode_display', clock.mode_display, clock.frame_interval(), fixed_rate=True)
+    clock_driver.register('spi_flush', clock.spi_flush, clock.flush_interval())
+
+    while not [c for c in SPI_FRAME_COMMANDS if c in bus.commands]:
+        clock_driver.dispatch()
+
+    sys.stdout.write('{} {}\n'.format(time.time(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+###############################################################################
+#
+# Startup
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,585 @@
+/*
+ *  bench-isr.c
+ *
+ * Host benchmark of the AVR controller timer and SPI logic in avr-nixie-logic.h.
+ *
+ * The firmware logic is run side by side with a reference copy of the firmware 1.2
+ * ISRs, with 16-bit modulo LED and second timing, through a scripted sequence of
+ * SPI commands: digit changes with and without crossfade, brightness changes with
+ * and without ramp, and a watch-dog expiry and recovery.
+ * The benchmark checks that every port B and D output and every SPI reply is the
+ * same as the reference, counts multiplex operations (digit 'on', crossfade switch,
+ * blanking, LED toggles and watch-dog seconds), and compares host time per timer tick.
+ * Host time is an indication only, AVR cycle counts need an avr-gcc listing.
+ * The time of day clock, which the reference does not have, is then checked on its
+ * own: 12 and 24 hour digit rolls, time read-back, and a watch-dog expiry while the
+ * AVR keeps time.
+ *
+ * build and run: gcc -O2 -o bench-isr bench-isr.c && ./bench-isr
+ *
+ * The benchmark exits with code 1 if the logic and the reference differ,
+ * or if the clock check fails.
+ *
+ */
+
+#include    <stdio.h>
+#include    <stdint.h>
+#include    <time.h>
+
+#include    "avr-nixie-logic.h"
+
+#define     TICKS_PER_SEC   5000        // 200uSec timer ticks
+#define     RUN_SECONDS     40
+#define     BENCH_TICKS     20000000
+
+/****************************************************************************
+  Reference firmware 1.2 timer and SPI logic
+****************************************************************************/
+volatile uint8_t ref_light_sensor;
+volatile int     ref_watch_dog_counter = 0;
+volatile int     ref_brightness_level = 1;
+volatile int     ref_dimming_interval = MAX_DIMMING;
+volatile int     ref_dimming_target = MAX_DIMMING;
+volatile uint8_t ref_ramp_cycles = 0;
+volatile uint8_t ref_fade_cycles = 0;
+volatile uint8_t ref_fade_rate = 0;
+volatile uint8_t ref_digits[NUM_DIGITS] = {0, 0, 0, 0};
+volatile uint8_t ref_digits_old[NUM_DIGITS] = {0, 0, 0, 0};
+volatile uint8_t ref_fade_level[NUM_DIGITS] = {0, 0, 0, 0};
+
+static inline void ref_set_digit(uint8_t index, uint8_t digit)
+{
+    if ( ref_fade_rate && digit != ref_digits[index] )
+    {
+        ref_digits_old[index] = ref_digits[index];
+        ref_fade_level[index] = FADE_START;
+    }
+
+    ref_digits[index] = digit;
+}
+
+static inline void ref_transitions(void)
+{
+    static uint8_t  ramp_counter = 0;
+    uint8_t         i;
+
+    for ( i = 0; i < NUM_DIGITS; i++ )
+    {
+        if ( ref_fade_level[i] > ref_fade_rate )
+            ref_fade_level[i] -= ref_fade_rate;
+        else
+            ref_fade_level[i] = 0;
+    }
+
+    if ( ref_dimming_interval == ref_dimming_target )
+        return;
+
+    ramp_counter++;
+    if ( ramp_counter < ref_ramp_cycles )
+        return;
+
+    ramp_counter = 0;
+    if ( ref_dimming_interval < ref_dimming_target )
+        ref_dimming_interval++;
+    else
+        ref_dimming_interval--;
+}
+
+void ref_timer_isr(uint8_t *port_B, uint8_t *port_D)
+{
+    static int      seconds_flash_interval = 0;
+    static int      digit_multiplexer = 0;
+    static int      digit_index = 0;
+    static uint8_t  digit_on_time = BLANKING + MAX_DIMMING;
+    static uint8_t  digit_switch_time = BLANKING + MAX_DIMMING;
+    uint8_t         port_B_temp, port_D_temp;
+    int             flash_rate;
+
+    port_B_temp = *port_B;
+    port_D_temp = *port_D;
+
+    if ( ref_watch_dog_counter >= WDOG_EXPIRE || ref_brightness_level == 0 )
+        port_B_temp &= ~HV_ENABLE;
+    else
+        port_B_temp |= HV_ENABLE;
+
+    if ( ref_watch_dog_counter >= WDOG_EXPIRE )
+        flash_rate = FAST_FLASH;
+    else
+        flash_rate = ONE_SEC_FLASH;
+
+    seconds_flash_interval++;
+
+    if ( (seconds_flash_interval % flash_rate) == 0 )
+        port_B_temp ^= SECONDS_LED;
+
+    if ( (seconds_flash_interval % ONESEC_INTERVAL) == 0 )
+    {
+        seconds_flash_interval = 0;
+        if ( ref_watch_dog_counter < WDOG_EXPIRE )
+            ref_watch_dog_counter++;
+    }
+
+    digit_multiplexer++;
+
+    if ( digit_multiplexer == DIGIT_TIME_SLOT )
+    {
+        port_D_temp &= ANODES_OFF;
+
+        digit_multiplexer = 0;
+        digit_index++;
+        if ( digit_index >= NUM_DIGITS )
+        {
+            digit_index = 0;
+            ref_transitions();
+        }
+
+        digit_on_time = BLANKING + ref_dimming_interval;
+        digit_switch_time = digit_on_time +
+                            (uint8_t)(((uint16_t) ref_fade_level[digit_index] * (DIGIT_TIME_SLOT - digit_on_time)) >> 8);
+    }
+    else if ( digit_multiplexer == digit_on_time )
+    {
+        if ( digit_switch_time > digit_on_time )
+            port_D_temp = digit_port(port_D_temp, ref_digits_old[digit_index], digit_index);
+        else
+            port_D_temp = digit_port(port_D_temp, ref_digits[digit_index], digit_index);
+    }
+    else if ( digit_multiplexer == digit_switch_time )
+    {
+        port_D_temp = digit_port(port_D_temp, ref_digits[digit_index], digit_index);
+    }
+
+    port_B_temp ^= TIMING_TEST;
+
+    *port_B = port_B_temp;
+    *port_D = port_D_temp;
+}
+
+void ref_spi_isr(uint8_t *spdr)
+{
+    static int byte_count_seq = 0;
+    static int last_command = 0;
+    uint8_t    valid_command = 1;
+    uint8_t    spi_data_byte = *spdr;
+
+    if ( byte_count_seq == 0 )
+        last_command = spi_data_byte;
+
+    switch ( last_command )
+    {
+        case SPI_CMD_SET_MIN:
+        case SPI_CMD_SET_MINTEN:
+        case SPI_CMD_SET_HR:
+        case SPI_CMD_SET_HRTEN:
+            if ( byte_count_seq == 0 )
+                *spdr = ref_digits[last_command - SPI_CMD_SET_MIN];
+            else
+                ref_set_digit(last_command - SPI_CMD_SET_MIN, spi_data_byte);
+            break;
+
+        case SPI_CMD_BRIGHTNESS:
+            if ( byte_count_seq == 0 )
+                *spdr = SPI_DUMMY_BYTE;
+            else
+                ref_brightness_level = spi_data_byte;
+
+            ref_dimming_target = (-2 * ref_brightness_level) + 20;
+            if ( ref_dimming_target > MAX_DIMMING )
+                ref_dimming_target = MAX_DIMMING;
+            else if ( ref_dimming_target < 0 )
+                ref_dimming_target = 0;
+
+            if ( ref_ramp_cycles == 0 )
+                ref_dimming_interval = ref_dimming_target;
+            break;
+
+        case SPI_CMD_GET_LIGHT:
+            if ( byte_count_seq == 0 )
+                *spdr = ref_light_sensor;
+            break;
+
+        case SPI_CMD_GET_VER:
+            if ( byte_count_seq == 0 )
+                *spdr = VERSION;
+            break;
+
+        case SPI_CMD_GET_CAPS:
+            if ( byte_count_seq == 0 )
+                *spdr = CAPABILITIES;
+            break;
+
+        case SPI_CMD_SET_MINPAIR:
+            if ( byte_count_seq == 0 )
+                *spdr = (ref_digits[1] << 4) | (ref_digits[0] & 0x0f);
+            else
+            {
+                ref_set_digit(0, spi_data_byte & 0x0f);
+                ref_set_digit(1, spi_data_byte >> 4);
+            }
+            break;
+
+        case SPI_CMD_SET_HRPAIR:
+            if ( byte_count_seq == 0 )
+                *spdr = (ref_digits[3] << 4) | (ref_digits[2] & 0x0f);
+            else
+            {
+                ref_set_digit(2, spi_data_byte & 0x0f);
+                ref_set_digit(3, spi_data_byte >> 4);
+            }
+            break;
+
+        case SPI_CMD_SET_FADE:
+            if ( byte_count_seq == 0 )
+                *spdr = ref_fade_cycles;
+            else
+            {
+                ref_fade_cycles = spi_data_byte;
+                if ( ref_fade_cycles == 0 )
+                    ref_fade_rate = 0;
+                else
+                    ref_fade_rate = FADE_START / ref_fade_cycles;
+            }
+            break;
+
+        case SPI_CMD_SET_RAMP:
+            if ( byte_count_seq == 0 )
+                *spdr = ref_ramp_cycles;
+            else
+                ref_ramp_cycles = spi_data_byte;
+            break;
+
+        case SPI_CMD_WDOG:
+            if ( byte_count_seq == 0 )
+            {
+                *spdr = 170;
+                ref_watch_dog_counter = 0;
+            }
+            break;
+
+        default:
+            valid_command = 0;
+    }
+
+    if ( valid_command && byte_count_seq == 1 )
+        ref_watch_dog_counter = 0;
+
+    byte_count_seq++;
+    if ( byte_count_seq == 2 )
+        byte_count_seq = 0;
+}
+
+/****************************************************************************
+  SPI command script
+****************************************************************************/
+struct spi_event
+{
+    int     time;                       // in mSec
+    uint8_t command;
+    uint8_t data;
+};
+
+struct spi_event script[] =
+{
+    {    0, SPI_CMD_BRIGHTNESS, 10 },
+    {    0, SPI_CMD_SET_HRPAIR, 0x12 },
+    {    0, SPI_CMD_SET_MINPAIR, 0x34 },
+    { 1000, SPI_CMD_BRIGHTNESS, 5 },
+    { 1500, SPI_CMD_SET_MIN, 10 },
+    { 2000, SPI_CMD_SET_FADE, 15 },
+    { 2000, SPI_CMD_SET_RAMP, 3 },
+    { 2100, SPI_CMD_SET_MINPAIR, 0x59 },
+    { 2500, SPI_CMD_BRIGHTNESS, 1 },
+    { 3000, SPI_CMD_SET_MIN, 10 },
+    { 3200, SPI_CMD_SET_HR, 7 },
+    { 3300, SPI_CMD_BRIGHTNESS, 12 },
+    { 3400, SPI_CMD_SET_HRTEN, 2 },
+    { 4000, SPI_CMD_GET_LIGHT, SPI_DUMMY_BYTE },
+    { 4000, SPI_CMD_GET_VER, SPI_DUMMY_BYTE },
+    { 4000, SPI_CMD_GET_CAPS, SPI_DUMMY_BYTE },
+    { 5000, SPI_CMD_WDOG, SPI_DUMMY_BYTE },
+    { 6000, 200, 0 },                   // invalid command
+    { 9000, SPI_CMD_WDOG, SPI_DUMMY_BYTE },
+    // no keep-alive, watch-dog expires
+    {20000, SPI_CMD_WDOG, SPI_DUMMY_BYTE },
+    {21000, SPI_CMD_BRIGHTNESS, 0 },
+    {22000, SPI_CMD_BRIGHTNESS, 8 },
+    {23000, SPI_CMD_SET_MINPAIR, 0x00 },
+    {23000, SPI_CMD_SET_HRPAIR, 0x99 },
+    {24000, SPI_CMD_SET_FADE, 0 },
+    {24000, SPI_CMD_SET_RAMP, 0 },
+    {24500, SPI_CMD_SET_MINPAIR, 0x11 },
+    {25000, SPI_CMD_BRIGHTNESS, 3 },
+    {26000, SPI_CMD_SET_FADE, 1 },
+    {26000, SPI_CMD_SET_MINPAIR, 0x22 },
+    {27000, SPI_CMD_SET_FADE, 255 },
+    {27000, SPI_CMD_SET_MINPAIR, 0x33 },
+};
+
+#define     SCRIPT_EVENTS   (sizeof(script) / sizeof(struct spi_event))
+
+/****************************************************************************
+  Multiplex operation counts
+****************************************************************************/
+struct op_count
+{
+    long    digit_on;
+    long    digit_switch;
+    long    blanking;
+    long    led_toggle;
+    long    hv_change;
+};
+
+/* ----------------------------------------------------------------------------
+ * count_ops()
+ *
+ *  Count multiplex operations from a timer tick's port changes.
+ *
+ */
+void count_ops(struct op_count *ops, uint8_t port_B, uint8_t port_D, uint8_t last_B, uint8_t last_D)
+{
+    if ( (port_D & ~ANODES_OFF) && !(last_D & ~ANODES_OFF) )
+        ops->digit_on++;
+    else if ( (port_D & ~ANODES_OFF) && port_D != last_D )
+        ops->digit_switch++;
+    else if ( !(port_D & ~ANODES_OFF) && (last_D & ~ANODES_OFF) )
+        ops->blanking++;
+
+    if ( (port_B ^ last_B) & SECONDS_LED )
+        ops->led_toggle++;
+    if ( (port_B ^ last_B) & HV_ENABLE )
+        ops->hv_change++;
+}
+
+/* ----------------------------------------------------------------------------
+ * spi_transfer()
+ *
+ *  Transfer a 2-byte command to the logic and the reference,
+ *  return '1' if the replies are the same.
+ *
+ */
+int spi_transfer(uint8_t command, uint8_t data, uint8_t *spdr, uint8_t *ref_spdr)
+{
+    uint8_t reply, ref_reply;
+
+    *spdr = spi_byte(command);
+    *ref_spdr = command;
+    ref_spi_isr(ref_spdr);
+
+    reply = *spdr;
+    ref_reply = *ref_spdr;
+    *spdr = spi_byte(data);
+    *ref_spdr = data;
+    ref_spi_isr(ref_spdr);
+
+    if ( reply != ref_reply )
+        printf("command %d: reply %d, reference %d\n", command, reply, ref_reply);
+
+    return (reply == ref_reply);
+}
+
+/* ----------------------------------------------------------------------------
+ * clock_command()
+ *
+ *  Transfer a 2-byte command to the logic only, return the reply.
+ *
+ */
+uint8_t clock_command(uint8_t command, uint8_t data)
+{
+    uint8_t reply;
+
+    reply = spi_byte(command);
+    spi_byte(data);
+
+    return reply;
+}
+
+/* ----------------------------------------------------------------------------
+ * check_clock()
+ *
+ *  Run the logic for 'seconds' and one more tick that updates the ports, and check
+ *  the displayed time digits, left to right, and the high voltage state.
+ *  Return '1' if the check fails.
+ *
+ */
+int check_clock(const char *step, long seconds, const uint8_t *expected, uint8_t hv, uint8_t *port_B, uint8_t *port_D)
+{
+    long    tick;
+    uint8_t hv_on;
+
+    for ( tick = 0; tick <= seconds * TICKS_PER_SEC; tick++ )
+        timer_tick(port_B, port_D);
+
+    hv_on = (*port_B & HV_ENABLE) ? 1 : 0;
+    if ( digits[3] == expected[0] && digits[2] == expected[1] && digits[1] == expected[2] &&
+         digits[0] == expected[3] && hv_on == hv )
+        return 0;
+
+    printf("clock %s: digits %d %d %d %d HV %d, expected %d %d %d %d HV %d\n", step,
+           digits[3], digits[2], digits[1], digits[0], hv_on,
+           expected[0], expected[1], expected[2], expected[3], hv);
+    return 1;
+}
+
+/* ----------------------------------------------------------------------------
+ * clock_test()
+ *
+ *  Check the time of day clock, return the number of failed checks.
+ *
+ */
+int clock_test(uint8_t *port_B, uint8_t *port_D)
+{
+    static const uint8_t    eleven_59[] = {1, 1, 5, 9};
+    static const uint8_t    twelve_00[] = {1, 2, 0, 0};
+    static const uint8_t    twelve_01[] = {1, 2, 0, 1};
+    static const uint8_t    nine_05[] = {DIGIT_BLANK, 9, 0, 5};
+    static const uint8_t    nine_06[] = {0, 9, 0, 6};
+    int                     failures = 0;
+
+    clock_command(SPI_CMD_SET_FADE, 0);
+    clock_command(SPI_CMD_BRIGHTNESS, 10);
+
+    // Set 23:59:58 in 12-hour format, the digits roll to 12:00 after 2 seconds
+    clock_command(SPI_CMD_CLOCK_MODE, CLOCK_DISPLAY | CLOCK_12HOUR);
+    clock_command(SPI_CMD_CLOCK_HR, 23);
+    clock_command(SPI_CMD_CLOCK_MIN, 59);
+    clock_command(SPI_CMD_CLOCK_SEC, 58);
+    failures += check_clock("set", 0, eleven_59, 1, port_B, port_D);
+    failures += check_clock("roll", 2, twelve_00, 1, port_B, port_D);
+
+    if ( clock_command(SPI_CMD_CLOCK_HR, SPI_DUMMY_BYTE) != 0 ||
+         clock_command(SPI_CMD_CLOCK_MIN, SPI_DUMMY_BYTE) != 0 ||
+         clock_command(SPI_CMD_CLOCK_SEC, SPI_DUMMY_BYTE) != 0 ||
+         clock_command(SPI_CMD_CLOCK_MODE, SPI_DUMMY_BYTE) != (CLOCK_RUNNING | CLOCK_12HOUR) )
+    {
+        printf("clock read-back: wrong time or mode\n");
+        failures++;
+    }
+
+    // No keep-alive, the display stays on and keeps rolling
+    failures += check_clock("watch-dog", 60, twelve_01, 1, port_B, port_D);
+
+    // Leading hour digit is blank in 12-hour format only
+    clock_command(SPI_CMD_CLOCK_HR, 9);
+    clock_command(SPI_CMD_CLOCK_MIN, 5);
+    clock_command(SPI_CMD_CLOCK_SEC, 30);
+    failures += check_clock("12-hour", 0, nine_05, 1, port_B, port_D);
+    clock_command(SPI_CMD_CLOCK_MODE, CLOCK_DISPLAY);
+    failures += check_clock("24-hour", 30, nine_06, 1, port_B, port_D);
+
+    // With the clock display off, a watch-dog expiry turns off high voltage
+    clock_command(SPI_CMD_CLOCK_MODE, 0);
+    failures += check_clock("display off", WDOG_EXPIRE + 1, nine_06, 0, port_B, port_D);
+
+    return failures;
+}
+
+/* ----------------------------------------------------------------------------
+ * elapsed()
+ *
+ *  Return time in seconds since 'start'.
+ *
+ */
+double elapsed(struct timespec *start)
+{
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (now.tv_sec - start->tv_sec) + (now.tv_nsec - start->tv_nsec) / 1e9;
+}
+
+/* ----------------------------------------------------------------------------
+ * main()
+ *
+ */
+int main(void)
+{
+    struct op_count     ops = {0}, ref_ops = {0};
+    struct timespec     start;
+    volatile uint8_t    sink;
+    uint8_t             port_B = 0x40, port_D = 0, ref_port_B = 0x40, ref_port_D = 0;
+    uint8_t             last_B, last_D, ref_last_B, ref_last_D;
+    uint8_t             spdr = SPI_DUMMY_BYTE, ref_spdr = SPI_DUMMY_BYTE;
+    unsigned int        event = 0;
+    long                tick, mismatches = 0;
+    int                 clock_failures;
+    double              logic_time, ref_time;
+
+    light_sensor = 123;
+    ref_light_sensor = 123;
+
+    // Run the script, compare every tick
+    for ( tick = 0; tick < (long) RUN_SECONDS * TICKS_PER_SEC; tick++ )
+    {
+        while ( event < SCRIPT_EVENTS && (long) script[event].time * TICKS_PER_SEC / 1000 == tick )
+        {
+            if ( !spi_transfer(script[event].command, script[event].data, &spdr, &ref_spdr) )
+                mismatches++;
+            event++;
+        }
+
+        last_B = port_B;
+        last_D = port_D;
+        ref_last_B = ref_port_B;
+        ref_last_D = ref_port_D;
+
+        timer_tick(&port_B, &port_D);
+        ref_timer_isr(&ref_port_B, &ref_port_D);
+
+        count_ops(&ops, port_B, port_D, last_B, last_D);
+        count_ops(&ref_ops, ref_port_B, ref_port_D, ref_last_B, ref_last_D);
+
+        if ( port_B != ref_port_B || port_D != ref_port_D )
+        {
+            if ( mismatches < 10 )
+                printf("tick %ld: port B 0x%02x D 0x%02x, reference B 0x%02x D 0x%02x\n",
+                       tick, port_B, port_D, ref_port_B, ref_port_D);
+            mismatches++;
+        }
+    }
+
+    printf("timer ticks: %ld, SPI commands: %u, mismatches: %ld\n", tick, event, mismatches);
+    printf("operation         logic  reference\n");
+    printf("digit on      %9ld  %9ld\n", ops.digit_on, ref_ops.digit_on);
+    printf("digit switch  %9ld  %9ld\n", ops.digit_switch, ref_ops.digit_switch);
+    printf("blanking      %9ld  %9ld\n", ops.blanking, ref_ops.blanking);
+    printf("LED toggle    %9ld  %9ld\n", ops.led_toggle, ref_ops.led_toggle);
+    printf("HV on/off     %9ld  %9ld\n", ops.hv_change, ref_ops.hv_change);
+    printf("watch-dog     %9d  %9d\n", watch_dog_counter, ref_watch_dog_counter);
+
+    clock_failures = clock_test(&port_B, &port_D);
+    printf("clock checks failed: %d\n", clock_failures);
+
+    // Host time per timer tick
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    for ( tick = 0; tick < BENCH_TICKS; tick++ )
+        timer_tick(&port_B, &port_D);
+    logic_time = elapsed(&start);
+    sink = port_B ^ port_D;
+
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    for ( tick = 0; tick < BENCH_TICKS; tick++ )
+        ref_timer_isr(&ref_port_B, &ref_port_D);
+    ref_time = elapsed(&start);
+    sink = ref_port_B ^ ref_port_D;
+    (void) sink;
+
+    printf("host time per timer tick: logic %.2f[nSec], reference %.2f[nSec]\n",
+           logic_time * 1e9 / BENCH_TICKS, ref_time * 1e9 / BENCH_TICKS);
+
+    if ( mismatches || ops.digit_on != ref_ops.digit_on || ops.digit_switch != ref_ops.digit_switch ||
+         ops.blanking != ref_ops.blanking || ops.led_toggle != ref_ops.led_toggle || ops.hv_change != ref_ops.hv_change )
+    {
+        printf("FAIL: logic differs from reference\n");
+        return 1;
+    }
+
+    if ( clock_failures )
+    {
+        printf("FAIL: clock\n");
+        return 1;
+    }
+
+    printf("PASS\n");
+    return 0;
+}
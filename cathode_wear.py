@@ -0,0 +1,126 @@
+#
+# cathode_wear.py
+#
+#   Cathode wear accounting module for Nixie Tube clock.
+#   Keeps an on-time counter for every digit cathode of every tube, scaled by
+#   the display brightness the digit was shown at. Counters are updated
+#   incrementally from each frame sent to the display, and are persisted
+#   periodically to a memory mapped file so they survive restarts.
+#   The counters are used to select the least used cathodes for short
+#   anti-poisoning exercise sequences.
+#
+
+import os
+import time
+import mmap
+import struct
+from array import array
+
+NUM_TUBES = 4
+NUM_SYMBOLS = 11            # digits '0' to '9' and a blank 'off' digit
+NUM_DIGITS = 10
+DIGIT_OFF = 10
+MAX_BRIGHTNESS = 10
+
+WEAR_FORMAT = '<%dd' % (NUM_TUBES * NUM_SYMBOLS)
+WEAR_FILE_SIZE = struct.calcsize(WEAR_FORMAT)
+
+class CathodeWear:
+    """Per tube, per digit, brightness weighted on-time counters."""
+
+    def __init__(self, file_name=None):
+        """Initialize counters, and map them to 'file_name' if one is given."""
+
+        self.counters = array('d', [0.0] * (NUM_TUBES * NUM_SYMBOLS))
+        self.shown = [DIGIT_OFF] * NUM_TUBES
+        self.brightness = 0
+        self.time_source = time
+        self.last_update = time.time()
+        self.wear_file = None
+        self.wear_map = None
+
+        if file_name:
+            self.open(file_name)
+
+    def open(self, file_name):
+        """Map the counter file, creating it if it does not exist, and load the stored counters."""
+
+        if not os.path.isfile(file_name) or os.path.getsize(file_name) != WEAR_FILE_SIZE:
+            f = open(file_name, 'wb')
+            f.write(struct.pack(WEAR_FORMAT, *self.counters))
+            f.close()
+
+        self.wear_file = open(file_name, 'r+b')
+        self.wear_map = mmap.mmap(self.wear_file.fileno(), WEAR_FILE_SIZE)
+        self.counters = array('d', struct.unpack_from(WEAR_FORMAT, self.wear_map, 0))
+
+    def close(self):
+        """Persist counters and release the counter file."""
+
+        if self.wear_map:
+            self.persist()
+            self.wear_map.close()
+            self.wear_file.close()
+            self.wear_map = None
+            self.wear_file = None
+
+    def update(self, digits=(-1,-1,-1,-1), brightness=-1, time_now=None):
+        """
+        Account for the on-time of the frame currently shown, then record the new frame.
+        Call every time a frame is sent to the display; 'digits' and 'brightness'
+        follow the clock._display() convention where '-1' means no change.
+        """
+
+        if time_now is None:
+            time_now = self.time_source.time()
+
+        wear = (time_now - self.last_update) * self.brightness
+        if wear > 0:
+            for tube in range(0,NUM_TUBES):
+                self.counters[tube * NUM_SYMBOLS + self.shown[tube]] += wear
+
+        self.last_update = time_now
+
+        for tube in range(0,NUM_TUBES):
+            if (digits[tube] >= 0 and digits[tube] <= 9) or (digits[tube] == DIGIT_OFF):
+                self.shown[tube] = digits[tube]
+
+        if brightness > -1:
+            self.brightness = min(brightness, MAX_BRIGHTNESS)
+
+    def persist(self):
+        """Write counters to the memory mapped file."""
+
+        if self.wear_map:
+            self.update(time_now=self.time_source.time())
+            struct.pack_into(WEAR_FORMAT, self.wear_map, 0, *self.counters)
+            self.wear_map.flush()
+
+    def wear(self, tube, digit):
+        """Return accumulated brightness weighted on-time, in seconds, of a tube's digit."""
+
+        return self.counters[tube * NUM_SYMBOLS + digit]
+
+    def least_used(self, ratio=0.5, count=3):
+        """
+        Return a list of 'count' exercise frames, each a four digit list, made of the least used
+        cathodes of every tube. Only digits with wear below 'ratio' times the tube's most worn digit
+        are included, a tube with no such digits is left unchanged ('-1') in the frame.
+        An empty list is returned when no cathode needs exercising.
+        """
+
+        frames = []
+
+        for tube in range(0,NUM_TUBES):
+            base = tube * NUM_SYMBOLS
+            tube_wear = self.counters[base:base+NUM_DIGITS]
+            limit = max(tube_wear) * ratio
+            candidates = sorted(range(0,NUM_DIGITS), key=lambda d: tube_wear[d])
+            candidates = [d for d in candidates[:count] if tube_wear[d] < limit]
+
+            for n in range(0,len(candidates)):
+                if n == len(frames):
+                    frames.append([-1] * NUM_TUBES)
+                frames[n][tube] = candidates[n]
+
+        return frames
@@ -3,13 +3,36 @@
 #
 #   Clock module for Nixie Tube clock.
 #   Display driver for time, date, and "slot machine" effects.
+#   High-refresh display modes show seconds, a stopwatch or a countdown timer
+#   at a steady frame rate, with frame rate and dropped frame statistics.
+#   Effects are run by the effect registry according to the <effects> configuration.
 #   Reads ambient light sensor and controls tube display intensity.
 #   Configuration is controlled through parameters read from XML configuration file.
-#   This module also has a GPIO and SPI initialization function and AVR watchdog reset.
+#   This module also has a GPIO and SPI initialization function, firmware capability
+#   negotiation, and AVR watchdog link recovery and reset.
+#   Digit crossfade and brightness ramp are done by the AVR firmware when it supports
+#   them, configured once and then triggered by the regular digit and brightness commands.
+#   When the AVR firmware keeps time, the AVR clock is set at start-up and at the sync
+#   interval, and checked once a minute. The AVR then rolls the time digits itself, so
+#   the time digits are not sent and the clock keeps time if this program stalls.
+#   All SPI commands go through the SPI bus arbiter, and can optionally be recorded
+#   to a binary log by the SPI recorder.
+#   Clock events are logged to a ring buffered event log, drained periodically to tmpfs.
+#   Time is read from an injectable time source, the 'time' module by default,
+#   which allows simulation in virtual time.
 #
 
 import time
-import libbcm2835._bcm2835 as soc
+try:
+    import libbcm2835._bcm2835 as soc
+except ImportError:
+    soc = None              # No hardware, set to avr_model.SimulatedBcm2835 for simulation
+import cathode_wear
+import configuration
+import effect_registry
+import event_log
+import link_recovery
+import spi_bus
 
 # SPI commands
 SPI_CMD_MINUTES = 1
@@ -18,29 +41,146 @@ SPI_CMD_HOURS = 3
 SPI_CMD_TENS_HOURS = 4
 SPI_CMD_BRIGHTNESS = 5
 SPI_CMD_GET_LIGHT = 6
+SPI_CMD_GET_VER = 7
+SPI_CMD_GET_CAPS = 8
+SPI_CMD_MINUTES_PAIR = 9
+SPI_CMD_HOURS_PAIR = 10
+SPI_CMD_SET_FADE = 11
+SPI_CMD_SET_RAMP = 12
+SPI_CMD_CLOCK_MODE = 13
+SPI_CMD_CLOCK_HR = 14
+SPI_CMD_CLOCK_MIN = 15
+SPI_CMD_CLOCK_SEC = 16
 SPI_CMD_WDOG = 85
 WATCH_DOG_REPLY = 170
 DUMMY = 255
 DIGIT_OFF = 10
+DIGIT_REGISTERS = {SPI_CMD_TENS_HOURS:(0,), SPI_CMD_HOURS:(1,), SPI_CMD_TENS_MINUTES:(2,), SPI_CMD_MINUTES:(3,),
+                   SPI_CMD_HOURS_PAIR:(0,1), SPI_CMD_MINUTES_PAIR:(2,3)}   # Tube digits written by digit commands
 
-# Internal variables  
-display = [0,0,0,0]
-gpio_initialized = 0
-date_display_lock = 0
-slot_machine_lock = 0
+# Firmware capabilities
+CAPS_VERSION = 0x11         # First firmware version that supports SPI_CMD_GET_CAPS
+CAP_PACKED_DIGITS = 0x01    # Two digits per SPI command
+CAP_IMPLICIT_WDOG = 0x02    # Any complete SPI command resets the AVR watchdog
+CAP_AVG_SENSOR = 0x04       # Light sensor reading is averaged by the AVR
+CAP_FW_EFFECTS = 0x08       # Firmware display effects
+CAP_TIMEKEEPING = 0x10      # AVR keeps time of day and rolls the time digits
+CAP_NAMES = {CAP_PACKED_DIGITS:'packed_digits', CAP_IMPLICIT_WDOG:'implicit_watchdog',
+             CAP_AVG_SENSOR:'averaged_sensor', CAP_FW_EFFECTS:'firmware_effects',
+             CAP_TIMEKEEPING:'timekeeping'}
+IMPLICIT_WDOG_WINDOW = 2.0  # Skip watchdog command if a verified command was sent within this time in seconds
+SENSOR_SAMPLES = 5          # Light sensor samples averaged when the AVR does not average
+MULTIPLEX_CYCLE = 0.02      # AVR four digit multiplex cycle in seconds, the firmware transition time unit
+DIMMING_STEPS = 18          # AVR dimming steps between brightness 1 and 10
+SPI_COMMAND_TIME = 16 * 65536 / 250.0e6 # 2-byte SPI command time in seconds at BCM2835_SPI_CLOCK_DIVIDER_65536
 
-# Clock configuration variables
-CFG_CLOCK_12HOUR = 0        # 12 or 24 hour time format
-CFG_SLOT_MACHINE = 2        # Minute interval for slot machine effect
-CFG_SHOW_DATE = 0           # Show date at top of hour
-CFG_DIPLAY_OFF = (0,0)      # Turn off clock display
-CFG_DISPLAY_ON = (8,0)      # Turn on clock display
+# AVR time keeping
+CLOCK_DISPLAY = 0x01        # AVR rolls the time digits every minute
+CLOCK_12HOUR = 0x02         # AVR time digits in 12-hour format
+CLOCK_SYNCED = 0x80         # AVR time was set since its last reset, read only
+TIME_SYNC_INTERVAL = 60     # Default AVR clock sync interval in minutes
+TIME_STEP = 2               # AVR clock offset in seconds, found by the minute check, that sets the AVR clock
+SECONDS_PER_DAY = 86400
 
-def initialize():
+WEAR_FILE = 'cathode_wear.dat'
+EXERCISE_RATIO = 0.5        # Exercise digits with less than this ratio of the tube's most used digit on-time
+EXERCISE_DIGITS = 3         # Maximum exercise frames per run
+EXERCISE_TIME = 1.0         # Exercise frame display time in seconds
+RECORDER_FILE = '/dev/shm/nixie-spi.log'
+EVENT_LOG_FILE = '/dev/shm/nixie-events.log'
+EVENT_PERSIST_INTERVAL = 3600.0 # Interval in seconds of compacted event log copies to persistent storage
+
+# Display modes, 'time' is the regular clock display, the other modes are high-refresh modes
+DISPLAY_MODES = ('time', 'seconds', 'stopwatch', 'countdown')
+FRAME_RATE = 10.0           # High-refresh mode frames per second
+MAX_FRAME_RATE = 20.0
+COUNTDOWN = 300.0           # Default countdown time in seconds
+MODE_IDLE_INTERVAL = 1.0    # mode_display() call interval in 'time' mode
+FLUSH_IDLE_INTERVAL = 1.0   # spi_flush() call interval with no SPI writes queued
+FRAME_TOLERANCE = 1e-6      # Frame due time tolerance in seconds, absorbs rounding of accumulated frame times
+WATCHDOG_HOLD = 2.0         # Longest effect frame hold time between watchdog commands
+AVR_RESET_PULSE = 0.001     # AVR reset pulse width in seconds
+AVR_RESET_SETTLE = 0.1      # AVR start-up time after reset in seconds
+
+class _ClockState(object):
+    """Clock internal variables and configuration variables."""
+
+    __slots__ = ('time_source', 'display', 'shadow_digits', 'shadow_brightness', 'firmware_version',
+                 'firmware_caps', 'last_verified_command', 'digit_replies', 'digit_mismatch', 'light_samples', 'date_display_lock', 'recorder',
+                 'fade_cycles', 'ramp_cycles', 'brightness', 'last_persist',
+                 'mode', 'mode_config', 'frame_rate', 'countdown', 'mode_start', 'frame_due', 'frame_digits',
+                 'frames', 'dropped_frames', 'jitter_total', 'jitter_max',
+                 'timekeeping', 'sync_interval', 'clock_flags', 'clock_minute', 'last_sync', 'syncs', 'time_steps',
+                 'drift', 'drift_interval', 'sync_deferred',
+                 'clock_12hour', 'show_date', 'display_off', 'display_on')
+
+    def __init__(self):
+        """Initialize clock state."""
+
+        # Internal variables
+        self.time_source = time
+        self.display = [0,0,0,0]
+        self.shadow_digits = [0,0,0,0]     # AVR power-on digits
+        self.shadow_brightness = 1
+        self.firmware_version = 0
+        self.firmware_caps = 0
+        self.last_verified_command = 0.0
+        self.digit_replies = 0
+        self.digit_mismatch = 0
+        self.light_samples = []
+        self.date_display_lock = 0
+        self.recorder = None
+        self.fade_cycles = 0
+        self.ramp_cycles = 0
+        self.brightness = -1
+        self.last_persist = 0.0
+
+        # High-refresh display mode and frame statistics
+        self.mode = 'time'
+        self.mode_config = None
+        self.frame_rate = FRAME_RATE
+        self.countdown = COUNTDOWN
+        self.mode_start = 0.0
+        self.frame_due = 0.0
+        self.frame_digits = None
+        self.frames = 0
+        self.dropped_frames = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+
+        # AVR time keeping, the AVR clock mode flags are '0' after an AVR reset
+        self.timekeeping = 0
+        self.sync_interval = TIME_SYNC_INTERVAL * 60.0
+        self.clock_flags = 0
+        self.clock_minute = -1
+        self.last_sync = 0.0
+        self.syncs = 0
+        self.time_steps = 0
+        self.drift = 0
+        self.drift_interval = 0.0
+        self.sync_deferred = 0
+
+        # Clock configuration variables
+        self.clock_12hour = 0       # 12 or 24 hour time format
+        self.show_date = 0          # Show date at top of hour
+        self.display_off = (0,0)    # Turn off clock display
+        self.display_on = (8,0)     # Turn on clock display
+
+state = _ClockState()
+wear = cathode_wear.CathodeWear()
+effects = effect_registry.EffectRegistry()
+events = event_log.EventLog()
+effects.event_log = events
+configuration.event_log = events
+
+def initialize(param={}):
     """
     Clock hardware initialization.
     Any exceptions raised here should not abort the program,
     but return a '0' to indicate initialization failure.
+    Initialization also fails if the configuration file is invalid, or if the
+    AVR firmware version is lower than the optional 'firmware_min_version'
+    configuration parameter.
     """
 
     # Initialize RPi GPIO
@@ -58,98 +198,530 @@ def initialize():
         soc.bcm2835_spi_setClockDivider(soc.BCM2835_SPI_CLOCK_DIVIDER_65536)
         soc.bcm2835_spi_chipSelect(soc.BCM2835_SPI_CS1)
         soc.bcm2835_spi_setChipSelectPolarity(soc.BCM2835_SPI_CS0, soc.LOW)
+
+        # Select SPI command set supported by the AVR firmware
+        _negotiate()
     except:
         gpio_initialized = 0
 
+    # An invalid configuration file was reported by configuration.get_clock_config()
+    if 'config_error' in param:
+        gpio_initialized = 0
+    elif 'firmware_min_version' in param:
+        min_version = configuration.version_byte(param['firmware_min_version'])
+        if min_version is None:
+            events.log('config_error', firmware_min_version=param['firmware_min_version'])
+            gpio_initialized = 0
+        elif state.firmware_version < min_version:
+            gpio_initialized = 0
+
+    events.log('initialize', status=gpio_initialized, firmware=firmware_info()['version'])
+
+    # Cathode wear counters, a failure here only loses wear history
+    try:
+        wear.open(param.get('wear_file', WEAR_FILE))
+    except:
+        pass
+
     return gpio_initialized
 
 def watchdog(param={}):
-    """Function that sends SPI commands to reset AVR controller watchdog time-out period."""
+    """
+    Function that sends SPI commands to reset AVR controller watchdog time-out period.
+    The command is sent ahead of all queued SPI writes.
+    A wrong reply starts staged link recovery, an AVR reset is the last recovery stage.
+    The command is skipped if the AVR supports implicit watchdog and a command
+    with a verified reply was sent recently.
+    """
 
-    soc.bcm2835_spi_transfer(SPI_CMD_WDOG)
-    data_byte = soc.bcm2835_spi_transfer(DUMMY)
+    if (state.firmware_caps & CAP_IMPLICIT_WDOG) and state.time_source.time() - state.last_verified_command < IMPLICIT_WDOG_WINDOW:
+        return
+
+    data_byte = bus.command(spi_bus.PRIORITY_KEEP_ALIVE, SPI_CMD_WDOG)
     if data_byte != WATCH_DOG_REPLY:
-        # TODO is an AVR reset too harsh?
-        _avr_reset()
+        events.log('watchdog_failure', reply=data_byte)
+
+    stage = link.check(data_byte)
+    if stage:
+        events.log('link_recovered', stage=stage, recovery_time='{:.3f}'.format(link.last_recovery_time))
+
+def set_time_source(source):
+    """
+    Set the time source used by the clock, an object with the time(), localtime() and sleep()
+    functions of the 'time' module, for example a virtual_time.VirtualTime.
+    """
+
+    state.time_source = source
+    wear.time_source = source
+    wear.last_update = source.time()
+    link.time_source = source
+    bus.time_source = source
+    events.time_source = source
+    if state.recorder:
+        state.recorder.time_source = source
+
+def firmware_info():
+    """Return the negotiated AVR firmware version and capability names, for diagnostics."""
+
+    caps = [CAP_NAMES[cap] for cap in sorted(CAP_NAMES) if state.firmware_caps & cap]
+    return {'version':'{}.{}'.format(state.firmware_version >> 4, state.firmware_version & 0x0f), 'capabilities':caps}
+
+def bus_info():
+    """Return SPI bus arbiter queue depth, coalescing and wait time statistics, for diagnostics."""
+
+    return bus.stats()
+
+def wear_persist(param={}):
+    """Save cathode wear counters, call periodically."""
+
+    wear.persist()
+
+def spi_record(param={}):
+    """Start, stop, and flush the SPI transaction recorder according to configuration, call periodically."""
+
+    if param.get('spi_recorder', 'no') == 'yes':
+        if state.recorder is None:
+            import spi_recorder
+            state.recorder = spi_recorder.SpiRecorder(param.get('spi_recorder_file', RECORDER_FILE))
+            state.recorder.time_source = state.time_source
+            state.recorder.state_source = _avr_state
+            state.recorder.record_state()
+        state.recorder.flush()
+    elif state.recorder:
+        state.recorder.close()
+        state.recorder = None
+
+def set_display_mode(mode, frame_rate=FRAME_RATE, countdown=COUNTDOWN):
+    """
+    Select the display mode at run time: 'time', 'seconds' (minutes and seconds),
+    'stopwatch' (starts at zero), or 'countdown' from 'countdown' seconds.
+    High-refresh modes run at 'frame_rate' frames per second, up to MAX_FRAME_RATE, with the
+    firmware crossfade and brightness ramp off. An unknown mode selects 'time'.
+    Frame statistics restart with the mode.
+    """
+
+    if mode not in DISPLAY_MODES:
+        mode = 'time'
+
+    high_refresh = state.mode != 'time'
+    state.mode = mode
+    if high_refresh != (mode != 'time'):
+        _send_transitions()
+    state.frame_rate = min(max(frame_rate, 1.0), MAX_FRAME_RATE)
+    state.countdown = countdown
+    state.mode_start = state.time_source.time()
+    state.frame_due = state.mode_start
+    state.frame_digits = None
+    state.frames = 0
+    state.dropped_frames = 0
+    state.jitter_total = 0.0
+    state.jitter_max = 0.0
+
+    events.log('display_mode', mode=mode, frame_rate=state.frame_rate)
+
+def frame_interval():
+    """Return the call interval of mode_display() for the current display mode."""
+
+    if state.mode == 'time':
+        return MODE_IDLE_INTERVAL
+
+    return 1.0 / state.frame_rate
+
+def spi_flush(param={}):
+    """
+    Send SPI writes deferred by the SPI bus byte budget, register with the dispatcher
+    and set its interval to flush_interval(), so that deferred writes are sent at the next
+    bus tick and do not wait for the next display update.
+    """
+
+    if bus.depth() > 0:
+        bus.flush()
+
+def flush_interval():
+    """Return the call interval of spi_flush(), the bus tick while SPI writes are queued."""
+
+    if bus.depth() > 0:
+        return bus.tick
+
+    return FLUSH_IDLE_INTERVAL
+
+def mode_info():
+    """Return display mode, achieved frame rate, dropped frames and frame jitter in seconds, for diagnostics."""
+
+    run_time = state.time_source.time() - state.mode_start
+    return {'mode':state.mode, 'frame_rate':state.frame_rate, 'frames':state.frames,
+            'achieved_rate':state.frames / run_time if run_time > 0 else 0.0,
+            'dropped':state.dropped_frames, 'jitter_max':state.jitter_max,
+            'jitter_avg':state.jitter_total / state.frames if state.frames else 0.0}
+
+def mode_display(param={}):
+    """
+    High-refresh display driver for the 'seconds', 'stopwatch' and 'countdown' modes.
+    Register with the dispatcher as a fixed rate function, and set its interval to frame_interval().
+    Frames are scheduled at multiples of the frame period from the mode start; a frame
+    that is late by a whole period or more is dropped. Only changed digits are sent, brightness
+    is still set by time_display().
+    """
+
+    if state.mode == 'time':
+        return
+
+    time_now = state.time_source.time()
+    period = 1.0 / state.frame_rate
+    late = time_now - state.frame_due
+    if late < -FRAME_TOLERANCE:
+        return
+    late = max(late, 0.0)
+
+    if late >= period:
+        missed = int(late / period)
+        state.dropped_frames += missed
+        state.frame_due += missed * period
+        late -= missed * period
+
+    state.frames += 1
+    state.jitter_total += late
+    state.jitter_max = max(state.jitter_max, late)
+    state.frame_due += period
+
+    t = state.time_source.localtime(time_now)
+    if _display_off(t):
+        return
+
+    if state.mode == 'seconds':
+        digits = [t.tm_min // 10, t.tm_min % 10, t.tm_sec // 10, t.tm_sec % 10]
+    elif state.mode == 'stopwatch':
+        digits = _duration_digits(time_now - state.mode_start)
+    else:
+        remaining = state.countdown - (time_now - state.mode_start)
+        if remaining > 0:
+            digits = _duration_digits(remaining)
+        elif int(-remaining * 2) % 2 == 0:
+            digits = [0,0,0,0]
+        else:
+            digits = [DIGIT_OFF,DIGIT_OFF,DIGIT_OFF,DIGIT_OFF]
+
+    if digits != state.frame_digits:
+        _display(digits)
+        state.frame_digits = digits
+
+def time_info():
+    """
+    Return AVR time keeping state, the count of time syncs and of time steps found by the
+    minute check, and the last AVR clock drift in seconds measured over the drift interval.
+    """
+
+    return {'enabled':bool(state.clock_flags & CLOCK_DISPLAY), 'syncs':state.syncs, 'steps':state.time_steps,
+            'drift':state.drift, 'drift_interval':state.drift_interval}
+
+def log_events(param={}):
+    """
+    Drain the event log to its tmpfs file, and start a compacted copy to persistent storage
+    at its interval, according to configuration, call periodically.
+    """
+
+    if param.get('event_log', 'no') == 'yes':
+        events.configure(param.get('event_log_file', EVENT_LOG_FILE), persist_file=param.get('event_log_persist_file') or None)
+        events.drain()
+        time_now = state.time_source.time()
+        if time_now - state.last_persist >= float(param.get('event_log_persist_interval', EVENT_PERSIST_INTERVAL)):
+            if events.persist():
+                state.last_persist = time_now
+    else:
+        events.configure(None)
+        events.drain()
+
+def effect_frame(digits=(0,0,0,0), brightness=10, hold=0.2):
+    """
+    Display one effect frame and hold it for 'hold' seconds.
+    The AVR watchdog is kept alive during the hold time.
+    The frame is sent at effect priority, and if the SPI bus byte budget holds
+    it back, the wait for the next bus tick is part of the hold time.
+    'digits' and 'brightness' are the same as for _display().
+    """
+
+    _display(digits, brightness, spi_bus.PRIORITY_EFFECT)
+    watchdog()
+
+    while bus.depth() > 0 and hold > 0:
+        wait = min(max(bus.next_tick() - state.time_source.time(), 0.0), hold)
+        state.time_source.sleep(wait)
+        bus.flush()
+        hold = hold - wait
+
+    while hold > WATCHDOG_HOLD:
+        state.time_source.sleep(WATCHDOG_HOLD)
+        watchdog()
+        hold = hold - WATCHDOG_HOLD
+
+    state.time_source.sleep(hold)
 
 def time_display(param):
     """Clock display driver."""
 
-    global slot_machine_lock, date_display_lock
-    global CFG_CLOCK_12HOUR, CFG_SLOT_MACHINE, CFG_SHOW_DATE, CFG_DIPLAY_OFF, CFG_DISPLAY_ON
-
     # Parse configuration changes if any
     if param['config_change'] == 'yes':
 
         if param['display_date'] == 'no':
-            CFG_SHOW_DATE = 0
+            state.show_date = 0
         elif param['display_date'] == 'yes':
-            CFG_SHOW_DATE = 1
+            state.show_date = 1
 
         if param['time_format'] == '24':
-            CFG_CLOCK_12HOUR = 0
+            state.clock_12hour = 0
         elif param['time_format'] == '12':
-            CFG_CLOCK_12HOUR = 1
+            state.clock_12hour = 1
 
-        CFG_SLOT_MACHINE = int(param['slot_machine'])
+        effects.configure(param.get('effects', []))
+
+        state.timekeeping = 1 if param.get('timekeeping', 'no') == 'yes' else 0
+        state.sync_interval = 60.0 * float(param.get('time_sync_interval', TIME_SYNC_INTERVAL))
+
+        _set_transitions(float(param.get('crossfade', '0')), float(param.get('brightness_ramp', '0')))
 
         t = param['off_time_start']
-        CFG_DIPLAY_OFF = (int(t.split(':')[0]), int(t.split(':')[1]))
+        state.display_off = (int(t.split(':')[0]), int(t.split(':')[1]))
         t = param['off_time_end']
-        CFG_DIPLAY_ON = (int(t.split(':')[0]), int(t.split(':')[1]))
+        state.display_on = (int(t.split(':')[0]), int(t.split(':')[1]))
+
+        # A display mode is applied only when its configuration changed,
+        # so that a configuration reload does not restart a stopwatch or countdown
+        mode_config = (param.get('display_mode', 'time'), param.get('frame_rate', str(FRAME_RATE)),
+                       param.get('countdown', str(COUNTDOWN)))
+        if mode_config != state.mode_config:
+            set_display_mode(mode_config[0], float(mode_config[1]), float(mode_config[2]))
+            state.mode_config = mode_config
 
         param['config_change'] = 'no'
+        events.log('config_reload')
+
+    # Keep the AVR clock set, before reading the time because a sync can wait for a second boundary
+    if state.firmware_caps & CAP_TIMEKEEPING:
+        _keep_time()
 
     # Get current time
-    t = time.localtime()
+    t = state.time_source.localtime()
 
     # Manage clock 'on' period
-    tod = (t.tm_hour,t.tm_min)
-    if tod >= CFG_DIPLAY_OFF and tod < CFG_DISPLAY_ON:
-        _display(display, 0)
+    if _display_off(t):
+        if state.clock_flags & CLOCK_DISPLAY:
+            _display((-1,-1,-1,-1), 0)
+        else:
+            _display(state.display, 0)
+        return
+
+    # High-refresh display modes send their own digits, only brightness is set here
+    if state.mode != 'time':
+        _display((-1,-1,-1,-1), _ambient_brightness())
         return
         
     # Parse time and set digits
-    display[2] = int(t.tm_min/10)
-    display[3] = t.tm_min - display[2]*10
+    state.display = _time_digits(t)
+
+    # Date display at top of hour
+    if state.show_date == 1 and t.tm_min == 0:
+        if state.date_display_lock == 0:
+            _show_date(t.tm_mday, t.tm_mon, t.tm_year, state.display)
+            state.date_display_lock = 1
+            effects.lock()
+    else:
+        state.date_display_lock = 0
+
+    # Periodic effects
+    effects.run(t, state.display)
+
+    # Display time, only brightness if the AVR already shows the time digits
+    if (state.clock_flags & CLOCK_DISPLAY) and state.display == state.shadow_digits:
+        _display((-1,-1,-1,-1), _ambient_brightness())
+    else:
+        _display(state.display, _ambient_brightness())
+
+#
+# Private functions
+#
+
+def _display_off(t):
+    """Return True if time 't', a time.struct_time, is in the display 'off' period."""
+
+    tod = (t.tm_hour,t.tm_min)
+    return tod >= state.display_off and tod < state.display_on
+
+def _time_digits(t):
+    """Return the time digits of 't', a time.struct_time, in 12 or 24 hour format."""
+
+    digits = [0,0,0,0]
+    digits[2] = int(t.tm_min/10)
+    digits[3] = t.tm_min - digits[2]*10
     
     hour = t.tm_hour
-    if CFG_CLOCK_12HOUR == 1:
+    if state.clock_12hour == 1:
         if hour > 12:
             hour = hour - 12
         elif hour == 0:
             hour = 12
 
-    display[0] = int(hour/10)
-    display[1] = hour - display[0]*10
+    digits[0] = int(hour/10)
+    digits[1] = hour - digits[0]*10
 
-    if display[0] == 0 and CFG_CLOCK_12HOUR == 1:
-        display[0] = DIGIT_OFF
+    if digits[0] == 0 and state.clock_12hour == 1:
+        digits[0] = DIGIT_OFF
 
-    # Date display at top of hour
-    if CFG_SHOW_DATE == 1 and t.tm_min == 0:
-        if date_display_lock == 0:
-            _show_date(t.tm_mday, t.tm_mon, t.tm_year, display)
-            date_display_lock = 1
-            slot_machine_lock = 1
-    else:
-        date_display_lock = 0
-
-    # Periodic slot machine effect
-    # TODO the lock will prohibit the effect from running on 1-min interval
-    if t.tm_min % CFG_SLOT_MACHINE == 0:
-        if slot_machine_lock == 0:
-            _slot_machine(display)
-            slot_machine_lock = 1
-    else:
-        slot_machine_lock = 0
+    return digits
 
-    # Display time
-    _display(display, _get_brightness())
+def _keep_time():
+    """
+    Keep the AVR clock set while it shows the time: set the AVR clock mode, set the AVR time
+    at the sync interval, and check the AVR time once a minute, so that a step of the local
+    time, such as an NTP step or a daylight saving time change, is followed within a minute.
+    The AVR rolls the time digits every minute, the shadow digits and wear counters follow it.
+    """
 
-#
-# Private functions
-#
+    flags = 0
+    if state.timekeeping and state.mode == 'time':
+        flags = CLOCK_DISPLAY | (CLOCK_12HOUR if state.clock_12hour else 0)
+
+    if flags != state.clock_flags:
+        bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_MODE, flags)
+        state.clock_flags = flags
+
+    if not flags:
+        return
+
+    time_now = state.time_source.time()
+    t = state.time_source.localtime(time_now)
+
+    # After start-up or an AVR reset the AVR clock is set by the next call, so that
+    # the first frame is sent by the host and does not wait for a second boundary
+    if not state.last_sync and not state.sync_deferred:
+        state.sync_deferred = 1
+        return
+
+    if time_now - state.last_sync >= state.sync_interval:
+        _sync_time()
+    elif t.tm_min != state.clock_minute:
+        offset = _avr_offset(time_now)
+        if abs(offset) >= TIME_STEP:
+            state.time_steps += 1
+            events.log('time_step', offset=offset)
+            _sync_time(False)
+        else:
+            state.clock_minute = t.tm_min
+            _avr_rolled(_time_digits(t))
+
+def _sync_time(measure_drift=True):
+    """
+    Measure the AVR clock drift, then set the AVR clock to local time.
+    The AVR time is read in the middle of a second, so that the drift is rounded to whole
+    seconds, and set at the start of the next second; this waits up to 1.5 seconds.
+    The drift is not measured after a time step, the step is not drift.
+    """
+
+    if state.last_sync:
+        _check_clock_mode()
+
+    time_now = state.time_source.time()
+    read_time = int(time_now + 0.5) + 0.5
+    state.time_source.sleep(read_time - time_now)
+
+    # The AVR clock runs since the last sync, unless the AVR was reset
+    if state.last_sync and measure_drift:
+        state.drift = _avr_offset(read_time)
+        state.drift_interval = read_time - state.last_sync
+
+    # Hours and minutes are held by the AVR until the seconds are sent at the second boundary
+    sync_time = read_time + 0.5
+    t = state.time_source.localtime(sync_time)
+    bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_HR, t.tm_hour)
+    bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_MIN, t.tm_min)
+    state.time_source.sleep(max(sync_time - SPI_COMMAND_TIME - state.time_source.time(), 0.0))
+    bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_SEC, t.tm_sec)
+
+    state.last_sync = sync_time
+    state.sync_deferred = 0
+    state.clock_minute = t.tm_min
+    state.syncs += 1
+    events.log('time_sync', drift=state.drift, interval='{:.0f}'.format(state.drift_interval))
+
+    _avr_rolled(_time_digits(t))
+
+def _check_clock_mode():
+    """
+    Read the AVR clock mode, and resend it if the AVR lost its time or its mode, after an
+    AVR reset that was not done by this program, such as a brown-out or in-circuit programming.
+    """
+
+    flags = bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_MODE)
+    if (flags & CLOCK_SYNCED) and (flags & ~CLOCK_SYNCED) == state.clock_flags:
+        state.last_verified_command = state.time_source.time()
+        return
+
+    events.log('avr_clock_lost', flags=flags)
+    bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_MODE, state.clock_flags)
+    state.last_sync = 0.0
+
+def _avr_offset(time_now):
+    """Return the AVR clock offset from local time 'time_now' in whole seconds, between -12 and 12 hours."""
+
+    t = state.time_source.localtime(time_now)
+    local = t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec
+
+    offset = (_read_avr_time() - local) % SECONDS_PER_DAY
+    if offset >= SECONDS_PER_DAY // 2:
+        offset -= SECONDS_PER_DAY
+    return offset
+
+def _read_avr_time():
+    """
+    Return the AVR clock time in seconds since midnight, read again if the minute rolled during the read.
+    A valid time verifies the link, so that the next watchdog command can be skipped.
+    """
+
+    seconds = bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_SEC)
+    minutes = bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_MIN)
+    hours = bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_HR)
+    if bus.command(spi_bus.PRIORITY_TIME, SPI_CMD_CLOCK_SEC) < seconds:
+        return _read_avr_time()
+
+    if seconds < 60 and minutes < 60 and hours < 24:
+        state.last_verified_command = state.time_source.time()
+
+    return hours * 3600 + minutes * 60 + seconds
+
+def _avr_rolled(digits):
+    """The AVR set its time digits to 'digits', update the shadow digits and the wear counters."""
+
+    state.shadow_digits = list(digits)
+    wear.update(digits, time_now=state.time_source.time())
+
+def _duration_digits(seconds):
+    """
+    Return display digits for a duration in seconds: seconds and hundredths below 100 seconds,
+    minutes and seconds below 100 minutes, and hours and minutes above that.
+    """
+
+    if seconds < 100:
+        whole = int(seconds)
+        hundredths = int((seconds - whole) * 100)
+        return [whole // 10, whole % 10, hundredths // 10, hundredths % 10]
+
+    minutes = int(seconds) // 60
+    if minutes < 100:
+        whole = int(seconds) % 60
+        return [minutes // 10, minutes % 10, whole // 10, whole % 10]
+
+    hours = min(minutes // 60, 99)
+    minutes = minutes % 60
+    return [hours // 10, hours % 10, minutes // 10, minutes % 10]
+
+def _ambient_brightness():
+    """Return the brightness for the ambient light, and log brightness changes."""
+
+    brightness = _get_brightness()
+    if brightness != state.brightness:
+        events.log('brightness', level=brightness)
+        state.brightness = brightness
+
+    return brightness
 
 def _scroll_rtl(digits=(0,0,0,0), digit_delay=1.0):
     """Scroll the digits into the display shifting them from right to left."""
@@ -158,12 +730,13 @@ def _scroll_rtl(digits=(0,0,0,0), digit_delay=1.0):
         cmd = SPI_CMD_MINUTES
         digit_out = digits[shift]
         for d in range(0,4):
-            soc.bcm2835_spi_transfer(cmd)
-            digit_in = soc.bcm2835_spi_transfer(digit_out)
+            digit_in = bus.command(spi_bus.PRIORITY_EFFECT, cmd, digit_out)
             digit_out = digit_in
             cmd = cmd + 1
+        state.shadow_digits[:] = state.shadow_digits[1:] + [digits[shift]]
+        wear.update(state.shadow_digits, -1, state.time_source.time())
         watchdog()
-        time.sleep(digit_delay)
+        state.time_source.sleep(digit_delay)
 
 def _show_date(day, month, year, digits=(0,0,0,0)):
     """Display date sequence and then revert to content on 'digits'."""
@@ -172,7 +745,7 @@ def _show_date(day, month, year, digits=(0,0,0,0)):
     d = [10,10,10,10]
     _display(d)
     watchdog()
-    time.sleep(1)
+    state.time_source.sleep(1)
 
     # Scroll month and day
     d[0] = int(month/10)
@@ -184,7 +757,7 @@ def _show_date(day, month, year, digits=(0,0,0,0)):
     if d[2] == 0:
         d[2] = 10
     _scroll_rtl(d)
-    time.sleep(2)
+    state.time_source.sleep(2)
 
      # Scroll year
     d[0] = int(year/1000)
@@ -193,11 +766,11 @@ def _show_date(day, month, year, digits=(0,0,0,0)):
     d[3] = int(year - d[0]*1000 - d[1]*100 - d[2]*10)
     _display(d)
     watchdog()
-    time.sleep(3)
+    state.time_source.sleep(3)
 
     _display(digits)
 
-def _slot_machine(digits=(0,0,0,0)):
+def _slot_machine(digits=(0,0,0,0), params={}):
     """
     Produce a slot machine effect on the display to preserve tubes.
     The 'digits' tuple contain the final digits to display after the effect.
@@ -209,42 +782,113 @@ def _slot_machine(digits=(0,0,0,0)):
         for n in range(0,10):
             for d in range(0,(4-effect_count)):
                 slots[d] = n
-            _display(slots,10)
-            watchdog()
-            time.sleep(0.2)
+            effect_frame(slots,10,0.2)
         slots[3-effect_count] = digits[3-effect_count]
         _display(slots,10)
 
-def _display(digits=(0,0,0,0), brightness=-1):
+def _cathode_exercise(digits=(0,0,0,0), params={}):
+    """
+    Short anti-poisoning effect that lights only the least used cathodes of each tube,
+    as selected by the cathode wear counters, at full brightness.
+    Nothing is displayed if no cathode needs exercising.
+    """
+
+    for frame in wear.least_used(EXERCISE_RATIO, EXERCISE_DIGITS):
+        effect_frame(frame,10,EXERCISE_TIME)
+
+def _display(digits=(0,0,0,0), brightness=-1, priority=spi_bus.PRIORITY_TIME):
     """
     Send digits passed in a tuple, one number per Nixie tube.
     Integers '0' to '9' correspond to number digits.
     Integer '10' (DIGIT_OFF) signals a blank 'off' digit.
     Integer '-1' signals skip digit update.
     'brightness' of -1 skips display brightness change.
+    Digits are queued on the SPI bus at 'priority', brightness at the same or lower
+    brightness priority, and the bus queues are then flushed.
     """
     
-    # Send brightness command
+    # Queue brightness command
     if brightness > -1:
         if brightness > 10:
             brightness = 10
-        soc.bcm2835_spi_transfer(SPI_CMD_BRIGHTNESS)
-        soc.bcm2835_spi_transfer(int(brightness))
+        bus.write(max(priority, spi_bus.PRIORITY_BRIGHTNESS), SPI_CMD_BRIGHTNESS, int(brightness), _brightness_sent)
 
-    # Send digits
+    # Queue digits, a digit pair in one command if the AVR supports it
+    pair_sent = 0
     cmd = SPI_CMD_TENS_HOURS
     for d in range(0,4):
-        if (digits[d] >= 0 and digits[d] <= 9) or (digits[d] == DIGIT_OFF):
-            soc.bcm2835_spi_transfer(cmd)
-            data_byte = soc.bcm2835_spi_transfer(digits[d])
+        if pair_sent == 1:
+            pair_sent = 0
+        elif (state.firmware_caps & CAP_PACKED_DIGITS) and (d % 2) == 0 and _is_digit(digits[d]) and _is_digit(digits[d+1]):
+            pair_cmd = SPI_CMD_HOURS_PAIR if d == 0 else SPI_CMD_MINUTES_PAIR
+            bus.write(priority, pair_cmd, (digits[d] << 4) | digits[d+1], _digits_sent)
+            pair_sent = 1
+        elif _is_digit(digits[d]):
+            bus.write(priority, cmd, digits[d], _digits_sent)
         cmd = cmd - 1
 
+    bus.flush()
+    _verify_digits()
+
+    wear.update(digits, brightness, state.time_source.time())
+
+def _is_digit(digit):
+    """Return True if 'digit' is a digit or a blank digit that can be sent to the AVR."""
+
+    return (digit >= 0 and digit <= 9) or (digit == DIGIT_OFF)
+
+def _digits_sent(command, data_byte, reply):
+    """
+    SPI bus callback for a sent digit or digit pair command.
+    The reply is the digit, or digit pair, being replaced and is verified against the shadow digits.
+    A mismatch clears the last verified command time, so that the next watchdog command checks the link,
+    matching replies are counted and set the verified time in _verify_digits().
+    """
+
+    if command == SPI_CMD_HOURS_PAIR or command == SPI_CMD_MINUTES_PAIR:
+        d = 0 if command == SPI_CMD_HOURS_PAIR else 2
+        expected = (state.shadow_digits[d] << 4) | state.shadow_digits[d+1]
+        state.shadow_digits[d] = data_byte >> 4
+        state.shadow_digits[d+1] = data_byte & 0x0f
+    else:
+        d = SPI_CMD_TENS_HOURS - command
+        expected = state.shadow_digits[d]
+        state.shadow_digits[d] = data_byte
+
+    if reply == expected:
+        state.digit_replies += 1
+    else:
+        state.digit_mismatch = 1
+        state.last_verified_command = 0.0
+
+def _verify_digits():
+    """
+    Set the last verified command time after a bus flush if digit replies were received
+    and all of them matched, a matching reply after a mismatch does not verify the link.
+    """
+
+    if state.digit_replies and not state.digit_mismatch:
+        state.last_verified_command = state.time_source.time()
+
+    state.digit_replies = 0
+    state.digit_mismatch = 0
+
+def _brightness_sent(command, data_byte, reply):
+    """SPI bus callback for a sent brightness command."""
+
+    state.shadow_brightness = data_byte
+
 def _get_brightness():
     """Read light sensor then calculate and return brightness command value between 1 and 10."""
 
     # Get light sensor value, which can be between 0 and 255
-    soc.bcm2835_spi_transfer(SPI_CMD_GET_LIGHT)
-    light_sensor = soc.bcm2835_spi_transfer(DUMMY)
+    light_sensor = bus.command(spi_bus.PRIORITY_BRIGHTNESS, SPI_CMD_GET_LIGHT)
+
+    # Average sensor readings if the AVR does not
+    if not (state.firmware_caps & CAP_AVG_SENSOR):
+        state.light_samples.insert(0, light_sensor)
+        del state.light_samples[SENSOR_SAMPLES:]
+        light_sensor = sum(state.light_samples) / float(len(state.light_samples))
 
     br_cmd = int(light_sensor/20.0)
     if br_cmd > 10:
@@ -259,5 +903,133 @@ def _avr_reset():
 
     soc.bcm2835_gpio_set(soc.RPI_GPIO_P1_24)
     soc.bcm2835_gpio_clr(soc.RPI_GPIO_P1_24)
+    state.time_source.sleep(AVR_RESET_PULSE)
     soc.bcm2835_gpio_set(soc.RPI_GPIO_P1_24)
+    state.time_source.sleep(AVR_RESET_SETTLE)
+
+    # The AVR clock stops and is set again by the next time display
+    state.clock_flags = 0
+    state.last_sync = 0.0
+
+    events.log('avr_reset')
+
+    if state.recorder:
+        state.recorder.record_avr_reset()
+
+def _negotiate():
+    """Read AVR firmware version and capabilities, older firmware has no capabilities."""
+
+    state.firmware_version = bus.command(spi_bus.PRIORITY_RECOVERY, SPI_CMD_GET_VER)
+    if state.firmware_version == DUMMY:
+        state.firmware_version = 0
+
+    state.firmware_caps = 0
+    if state.firmware_version >= CAPS_VERSION:
+        state.firmware_caps = bus.command(spi_bus.PRIORITY_RECOVERY, SPI_CMD_GET_CAPS)
+
+    link.firmware_version = state.firmware_version
+
+def _set_transitions(crossfade, brightness_ramp):
+    """
+    Set the firmware digit crossfade time, and the brightness ramp time across the full
+    brightness range, in seconds. '0' is a hard cut. Ignored if the AVR has no firmware effects.
+    """
+
+    state.fade_cycles = min(int(round(crossfade / MULTIPLEX_CYCLE)), 255)
+    state.ramp_cycles = min(int(round(brightness_ramp / (DIMMING_STEPS * MULTIPLEX_CYCLE))), 255)
+    _send_transitions()
+
+def _transitions():
+    """
+    Return the crossfade and brightness ramp settings of the display mode, both are off
+    in the high-refresh display modes, where a crossfade is longer than a frame.
+    """
+
+    if state.mode == 'time':
+        return state.fade_cycles, state.ramp_cycles
+
+    return 0, 0
+
+def _send_transitions():
+    """Send the crossfade and brightness ramp settings of the display mode to the AVR."""
+
+    if state.firmware_caps & CAP_FW_EFFECTS:
+        fade_cycles, ramp_cycles = _transitions()
+        bus.write(spi_bus.PRIORITY_RECOVERY, SPI_CMD_SET_FADE, fade_cycles)
+        bus.write(spi_bus.PRIORITY_RECOVERY, SPI_CMD_SET_RAMP, ramp_cycles)
+        bus.flush()
+
+def _avr_state():
+    """
+    Return the AVR state for the SPI recorder: a time stamp and a list of (register command, value)
+    tuples of the firmware version, digits, brightness and transition settings sent to the AVR, and
+    the AVR clock mode and time. The time stamp is the start of the AVR clock's current second,
+    which is on a whole second of local time since the last sync.
+    """
+
+    time_now = state.time_source.time()
+    registers = [(SPI_CMD_GET_VER, state.firmware_version)]
+    registers += [(SPI_CMD_TENS_HOURS - d, state.shadow_digits[d]) for d in range(0,4)]
+    registers.append((SPI_CMD_BRIGHTNESS, state.shadow_brightness))
+
+    if state.firmware_caps & CAP_FW_EFFECTS:
+        fade_cycles, ramp_cycles = _transitions()
+        registers += [(SPI_CMD_SET_FADE, fade_cycles), (SPI_CMD_SET_RAMP, ramp_cycles)]
+
+    if state.firmware_caps & CAP_TIMEKEEPING:
+        registers.append((SPI_CMD_CLOCK_MODE, state.clock_flags))
+        if state.last_sync:
+            time_now = state.last_sync + int(time_now - state.last_sync)
+            t = state.time_source.localtime(time_now)
+            registers += [(SPI_CMD_CLOCK_HR, t.tm_hour), (SPI_CMD_CLOCK_MIN, t.tm_min), (SPI_CMD_CLOCK_SEC, t.tm_sec)]
+
+    return time_now, registers
+
+def _push_shadow():
+    """Resend the last transition settings, digits and brightness sent to the AVR."""
+
+    _send_transitions()
+    _display(state.shadow_digits, state.shadow_brightness, spi_bus.PRIORITY_RECOVERY)
+
+def _spi_transfer(data_byte):
+    """Transfer a single SPI byte, only used to re-sync the AVR's 2-byte command framing."""
+
+    reply = soc.bcm2835_spi_transfer(data_byte)
+
+    if state.recorder:
+        state.recorder.record_byte(data_byte, reply)
+
+    return reply
+
+def _recovery_command(command, data_byte=DUMMY):
+    """Send a link recovery SPI command through the SPI bus and return the AVR's response."""
+
+    return bus.command(spi_bus.PRIORITY_RECOVERY, command, data_byte)
+
+def _spi_command(command, data_byte=DUMMY):
+    """
+    Send a 2-byte SPI command and return the AVR's response to the second byte.
+    Only called by the SPI bus arbiter, other functions send commands through 'bus'.
+    """
+
+    soc.bcm2835_spi_transfer(command)
+    reply = soc.bcm2835_spi_transfer(data_byte)
+
+    if state.recorder:
+        state.recorder.record(command, data_byte, reply)
+
+    return reply
+
+#
+# Built-in effects
+#
+
+effects.register('slot_machine', _slot_machine, 5.0, 8.0)
+effects.register('cathode_exercise', _cathode_exercise, 1.0, EXERCISE_DIGITS*EXERCISE_TIME)
+
+#
+# SPI bus arbiter and link recovery
+#
 
+bus = spi_bus.SpiBus(_spi_command, registers=DIGIT_REGISTERS)
+link = link_recovery.LinkRecovery(_spi_transfer, _recovery_command, _avr_reset, _push_shadow)
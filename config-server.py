@@ -0,0 +1,85 @@
+#!/usr/bin/python
+###############################################################################
+#
+# config-server.py
+#
+#   Stand-in fleet configuration server for testing the clock's fleet
+#   configuration source (config_source.py) on a local network.
+#   Serves one clock configuration XML file at any path, with ETag and
+#   Last-Modified validators, and replies '304 Not Modified' to conditional
+#   requests for an unchanged file. Edit the file while the server runs to
+#   test configuration distribution.
+#
+#   usage: config-server.py <configuration file> [port]
+#          port: HTTP port, '8080' by default
+#
+###############################################################################
+
+import sys
+import os
+import hashlib
+import email.utils
+import BaseHTTPServer
+
+config_file = None
+
+class ConfigHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Conditional GET handler of the configuration file."""
+
+    def do_GET(self):
+        """Reply with the configuration file, or '304 Not Modified' if the client's copy is current."""
+
+        body = open(config_file, 'rb').read()
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        last_modified = email.utils.formatdate(int(os.path.getmtime(config_file)), usegmt=True)
+
+        # If-None-Match takes precedence over If-Modified-Since
+        if_none_match = self.headers.get('If-None-Match')
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_none_match is not None:
+            not_modified = if_none_match == etag
+        else:
+            not_modified = if_modified_since == last_modified
+
+        if not_modified:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+def main():
+    """Serve the configuration file until interrupted."""
+
+    global config_file
+
+    if len(sys.argv) < 2:
+        print('usage: config-server.py <configuration file> [port]')
+        sys.exit(1)
+
+    config_file = sys.argv[1]
+    port = 8080
+    if len(sys.argv) > 2:
+        port = int(sys.argv[2])
+
+    server = BaseHTTPServer.HTTPServer(('', port), ConfigHandler)
+    print('serving {} on port {}'.format(config_file, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+###############################################################################
+#
+# Startup
+#
+if __name__ == '__main__':
+    main()
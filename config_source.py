@@ -0,0 +1,165 @@
+#
+# config_source.py
+#
+#   Fleet configuration source for Nixie Tube clock.
+#   Fetches a clock configuration XML file from a central HTTP server, so that
+#   a fleet of clocks can be configured without editing each clock.xml over SSH.
+#   Fetches are conditional requests with the ETag and Last-Modified validators of
+#   the last fetch, so an unchanged configuration costs one '304 Not Modified' reply.
+#   Poll intervals are randomly spread by a jitter fraction, so that clocks that
+#   started together do not poll the server together.
+#   A fetched configuration is checked with configuration.check_config(), the same parse
+#   and value conversions the clock applies, and written to an on-disk cache file, which
+#   holds the last good configuration. The clock reads the cache file, so start-up
+#   never waits on the network or the server.
+#   Fetches run in a forked child process, so a slow server does not block the clock.
+#
+
+import os
+import random
+import time
+
+POLL_INTERVAL = 3600.0      # Seconds between fetches
+POLL_JITTER = 0.25          # Poll interval random spread fraction, the first poll is within this fraction of the interval
+FETCH_TIMEOUT = 10.0        # HTTP connect and read time out in seconds
+
+FETCH_UPDATED = 0           # Fetch results, also the fetch child process exit status
+FETCH_NOT_MODIFIED = 1
+FETCH_FAILED = 2
+FETCH_RESULTS = ('updated', 'not_modified', 'failed')
+
+class HttpConfigSource:
+    """Conditional HTTP fetch of a fleet configuration file into an on-disk cache."""
+
+    def __init__(self, url, cache_file, poll_interval=POLL_INTERVAL, jitter=POLL_JITTER):
+        """
+        Initialize a configuration source for 'url' cached in 'cache_file', the first
+        fetch is scheduled at a random time within the jitter fraction of the poll interval.
+        """
+
+        self.url = url
+        self.cache_file = cache_file
+        self.poll_interval = poll_interval
+        self.jitter = jitter
+        self.time_source = time
+
+        self.fetch_pid = 0
+        self.next_poll = self.time_source.time() + random.uniform(0.0, jitter * poll_interval)
+        self.results = [0] * len(FETCH_RESULTS)
+
+    def poll(self):
+        """
+        Collect the result of a finished fetch, and start a background fetch if one is due.
+        A fetch is skipped if the previous fetch is still running. Returns True if a fetch was started.
+        """
+
+        if self.fetch_pid:
+            pid, status = os.waitpid(self.fetch_pid, os.WNOHANG)
+            if pid == 0:
+                return False
+            self.fetch_pid = 0
+            result = os.WEXITSTATUS(status) if os.WIFEXITED(status) else FETCH_FAILED
+            self.results[min(result, FETCH_FAILED)] += 1
+
+        time_now = self.time_source.time()
+        if time_now < self.next_poll:
+            return False
+
+        self.next_poll = time_now + self.poll_interval * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+        pid = os.fork()
+        if pid == 0:
+            result = FETCH_FAILED
+            try:
+                result = self.fetch()
+            finally:
+                os._exit(result)
+
+        self.fetch_pid = pid
+        return True
+
+    def fetch(self):
+        """
+        Fetch the configuration with a conditional request, and write it to the cache file
+        if it changed and is a valid clock configuration. Returns one of the FETCH_ results.
+        """
+
+        import urllib2
+        import xml.etree.ElementTree as ET
+        import configuration
+
+        etag, last_modified = self.validators()
+
+        request = urllib2.Request(self.url)
+        if etag:
+            request.add_header('If-None-Match', etag)
+        if last_modified:
+            request.add_header('If-Modified-Since', last_modified)
+
+        try:
+            response = urllib2.urlopen(request, timeout=FETCH_TIMEOUT)
+            body = response.read()
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return FETCH_NOT_MODIFIED
+            return FETCH_FAILED
+        except IOError:
+            return FETCH_FAILED
+
+        try:
+            configuration.check_config(ET.fromstring(body))
+        except (ET.ParseError, KeyError, ValueError):
+            return FETCH_FAILED
+
+        headers = response.info()
+        validators = '{}\n{}\n'.format(headers.get('ETag', ''), headers.get('Last-Modified', ''))
+
+        # A server without validators returns the full configuration every time,
+        # rewrite the cache only when it changed so that the clock does not reload
+        if self.cached() != body:
+            _write_file(self.cache_file, body)
+        _write_file(self.cache_file + '.meta', validators)
+
+        return FETCH_UPDATED
+
+    def cached(self):
+        """Return the cached configuration, or None if there is no cache file."""
+
+        if not os.path.isfile(self.cache_file):
+            return None
+        with open(self.cache_file, 'rb') as cache:
+            return cache.read()
+
+    def cache_time(self):
+        """Return the modification time of the cache file, or 0 if there is no cache file."""
+
+        if not os.path.isfile(self.cache_file):
+            return 0.0
+        return os.path.getmtime(self.cache_file)
+
+    def validators(self):
+        """Return the ETag and Last-Modified validators of the cached configuration, empty if unknown."""
+
+        meta_file = self.cache_file + '.meta'
+        if not os.path.isfile(self.cache_file) or not os.path.isfile(meta_file):
+            return '', ''
+
+        lines = open(meta_file).read().split('\n')
+        if len(lines) < 2:
+            return '', ''
+        return lines[0], lines[1]
+
+    def stats(self):
+        """Return the count of fetch results."""
+
+        return dict(zip(FETCH_RESULTS, self.results))
+
+def _write_file(file_name, data):
+    """Replace a file's contents through a temporary file, so that readers never see a partial file."""
+
+    temp_file = file_name + '.tmp'
+    with open(temp_file, 'wb') as out:
+        out.write(data)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(temp_file, file_name)
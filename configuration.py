@@ -6,34 +6,215 @@
 #   configuration.
 #   Call the get_clock_config() function periodically to capture configuration changes
 #   and apply them at run time to the clock
+#   An optional fleet configuration source, set in the <config_source> block, is fetched
+#   in the background into a cache file (config_source.py). The cached fleet configuration
+#   is parsed after the local file, so its settings override local settings, and a change
+#   of either file reloads the configuration. A fleet configuration is checked with
+#   check_config() when it is fetched and again when it is read, an invalid one is ignored
+#   and the clock runs on the local configuration.
+#   File paths and safety settings are taken only from the local file, as the clock runs
+#   as root, fleet configuration settings in LOCAL_SETTINGS are ignored and logged.
 #
 
 import os.path
-import xml.etree.ElementTree as ET
+
+CONFIG_FILE = 'clock.xml'
+
+LOCAL_SETTINGS = {'config_source':(), 'firmware':('min_version',), 'event_log':('file', 'persist_file'),
+                  'spi_recorder':('file',)}      # Local file only blocks and attributes, () for the whole block
+
+source = None               # Fleet configuration source, config_source.HttpConfigSource
+event_log = None            # Event log of ignored fleet configuration settings, set by the clock module
 
 def get_clock_config(param):
-    """Parse XML configuration file if it changed since the last check, and update clock configuration."""
+    """
+    Parse XML configuration file, and the cached fleet configuration, if either changed since
+    the last check, and update clock configuration. Start a background fleet configuration
+    fetch if one is due, the fetched configuration is applied on a later check.
+    The XML parser is imported only when a file needs parsing.
+    """
+
+    if os.path.isfile(CONFIG_FILE):
 
-    if os.path.isfile('clock.xml'):
+        if source:
+            source.poll()
 
-        if param['config_file_last_mod'] != os.path.getmtime('clock.xml'):
+        if param['config_file_last_mod'] != os.path.getmtime(CONFIG_FILE) or \
+           param.get('fleet_config_last_mod', 0.0) != _fleet_config_time():
 
-            param['config_file_last_mod'] = os.path.getmtime('clock.xml')
+            param['config_file_last_mod'] = os.path.getmtime(CONFIG_FILE)
             param['config_change'] = 'yes'
 
-            tree = ET.parse('clock.xml')
-            root = tree.getroot()
-
-            if root.tag == 'clock':
-                for parameter in root:
-                    if parameter.tag == 'time_format':
-                        param[parameter.tag] = parameter.attrib['value']                        
-                    elif parameter.tag == 'effects':
-                        for effect in parameter:
-                            param[effect.tag] = effect.attrib['period']
-                    elif parameter.tag == 'display_date':
-                        param[parameter.tag] = parameter.attrib['value']
-                    elif parameter.tag == 'display_off':
-                        param['off_time_start'] = parameter.attrib['start_time']
-                        param['off_time_end'] = parameter.attrib['end_time']
+            import xml.etree.ElementTree as ET
+            root = ET.parse(CONFIG_FILE).getroot()
+            try:
+                check_config(root, True)
+            except (KeyError, ValueError) as error:
+                # Keep the last valid configuration, initialization fails if there is none
+                param['config_error'] = str(error)
+                if event_log:
+                    event_log.log('config_error', file=CONFIG_FILE, error=str(error))
+                return
+            param.pop('config_error', None)
+            _parse_config(root, param, True)
+
+            # The local file sets the fleet configuration source
+            param['fleet_config_last_mod'] = _fleet_config_time()
+            if source and param['fleet_config_last_mod']:
+                try:
+                    root = ET.parse(source.cache_file).getroot()
+                    check_config(root)
+                except (IOError, ET.ParseError, KeyError, ValueError):
+                    root = None
+                if root is not None:
+                    ignored = _parse_config(root, param, False)
+                    if ignored and event_log:
+                        event_log.log('config_ignored', settings=' '.join(ignored))
+
+def check_config(root, local=False):
+    """
+    Check a parsed XML configuration before it is applied. The configuration is parsed into
+    a scratch dictionary and its values are converted the way the clock converts them, so
+    that an invalid configuration raises KeyError or ValueError here and not in the clock.
+    'local' also checks the settings accepted only from the local configuration file.
+    """
+
+    if root.tag != 'clock':
+        raise ValueError('not a clock configuration: <{}>'.format(root.tag))
+
+    scratch = {}
+    _parse_config(root, scratch, local)
+
+    if 'firmware_min_version' in scratch and version_byte(scratch['firmware_min_version']) is None:
+        raise ValueError('invalid firmware min_version \'{}\', expected \'major.minor\''.format(scratch['firmware_min_version']))
+
+    for key in ('crossfade', 'brightness_ramp', 'frame_rate', 'countdown', 'time_sync_interval', 'event_log_persist_interval'):
+        if key in scratch:
+            float(scratch[key])
+
+    for key in ('off_time_start', 'off_time_end'):
+        if key in scratch:
+            hour, minute = scratch[key].split(':')
+            int(hour), int(minute)
+
+    for name, params in scratch.get('effects', []):
+        int(params.get('period', '0'))
+
+def version_byte(version):
+    """
+    Return a 'major.minor' version string as an AVR firmware version byte, the major version
+    in the high nibble. A missing minor version is '0', an invalid version returns None.
+    """
+
+    parts = version.strip().split('.')
+    try:
+        major = int(parts[0])
+        minor = int(parts[1]) if len(parts) > 1 else 0
+    except ValueError:
+        return None
+
+    if len(parts) > 2 or major < 0 or major > 15 or minor < 0 or minor > 15:
+        return None
+
+    return (major << 4) + minor
+
+def config_source_info():
+    """Return fleet configuration source URL, cache file and fetch result counts, or None if not configured."""
+
+    if not source:
+        return None
+    return {'url':source.url, 'cache_file':source.cache_file, 'fetches':source.stats()}
+
+def _fleet_config_time():
+    """Return the modification time of the cached fleet configuration, 0 if there is none."""
+
+    if not source:
+        return 0.0
+    return source.cache_time()
+
+def _set_source(attrib):
+    """Create, replace or remove the fleet configuration source from the <config_source> attributes."""
+
+    global source
+
+    if attrib.get('value', 'no') != 'yes':
+        source = None
+        return
+
+    import config_source
+    url = attrib['url']
+    cache_file = attrib.get('cache_file', 'fleet-clock.xml')
+    poll_interval = float(attrib.get('poll_interval', config_source.POLL_INTERVAL))
+    jitter = float(attrib.get('jitter', config_source.POLL_JITTER))
+
+    if source and (source.url, source.cache_file) == (url, cache_file):
+        source.poll_interval = poll_interval
+        source.jitter = jitter
+    else:
+        source = config_source.HttpConfigSource(url, cache_file, poll_interval, jitter)
+
+def _parse_config(root, param, local):
+    """
+    Update clock configuration from a parsed XML configuration, the fleet configuration
+    source, file paths and safety settings can only be set by the 'local' file.
+    Returns the list of ignored 'block' and 'block.attribute' settings of a fleet configuration.
+    """
+
+    source_set = False
+    ignored = []
+
+    if root.tag == 'clock':
+        for parameter in root:
+            if not local and parameter.tag in LOCAL_SETTINGS:
+                attributes = LOCAL_SETTINGS[parameter.tag]
+                if not attributes:
+                    ignored.append(parameter.tag)
+                ignored.extend([parameter.tag + '.' + name for name in attributes if name in parameter.attrib])
+
+            if parameter.tag == 'config_source':
+                if local:
+                    _set_source(parameter.attrib)
+                    source_set = True
+            elif parameter.tag == 'time_format':
+                param[parameter.tag] = parameter.attrib['value']                        
+            elif parameter.tag == 'effects':
+                param['effects'] = [(effect.tag, dict(effect.attrib)) for effect in parameter]
+            elif parameter.tag == 'display_date':
+                param[parameter.tag] = parameter.attrib['value']
+            elif parameter.tag == 'display_off':
+                param['off_time_start'] = parameter.attrib['start_time']
+                param['off_time_end'] = parameter.attrib['end_time']
+            elif parameter.tag == 'display_mode':
+                param[parameter.tag] = parameter.attrib['value']
+                if 'frame_rate' in parameter.attrib:
+                    param['frame_rate'] = parameter.attrib['frame_rate']
+                if 'countdown' in parameter.attrib:
+                    param['countdown'] = parameter.attrib['countdown']
+            elif parameter.tag == 'transitions':
+                param['crossfade'] = parameter.attrib.get('crossfade', '0')
+                param['brightness_ramp'] = parameter.attrib.get('brightness_ramp', '0')
+            elif parameter.tag == 'timekeeping':
+                param[parameter.tag] = parameter.attrib['value']
+                if 'sync_interval' in parameter.attrib:
+                    param['time_sync_interval'] = parameter.attrib['sync_interval']
+            elif parameter.tag == 'firmware':
+                if local:
+                    param['firmware_min_version'] = parameter.attrib['min_version']
+            elif parameter.tag == 'event_log':
+                param[parameter.tag] = parameter.attrib['value']
+                if local:
+                    if 'file' in parameter.attrib:
+                        param['event_log_file'] = parameter.attrib['file']
+                    param['event_log_persist_file'] = parameter.attrib.get('persist_file', '')
+                if 'persist_interval' in parameter.attrib:
+                    param['event_log_persist_interval'] = parameter.attrib['persist_interval']
+            elif parameter.tag == 'spi_recorder':
+                param[parameter.tag] = parameter.attrib['value']
+                if local and 'file' in parameter.attrib:
+                    param['spi_recorder_file'] = parameter.attrib['file']
+
+    # A local file without a <config_source> block turns off the fleet configuration source
+    if local and not source_set:
+        _set_source({})
 
+    return ignored
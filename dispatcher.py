@@ -6,42 +6,81 @@
 #   This class is intended to be simple and no attempt was made at timing accuracy.
 #   Functions will be called if the predefined time interval is greater or equal
 #   to the time delta of the function's last invocation
+#   Fixed rate functions are scheduled at whole multiples of their interval, so that
+#   late invocations do not accumulate drift, for example display frame updates.
+#   Time is read from an injectable time source, the 'time' module by default.
 #
 
 import time
 
+TIME_RESOLUTION = 1e-6      # Due time tolerance in seconds, absorbs rounding of accumulated fixed rate times
+
+class _Task(object):
+    """Registered function record."""
+
+    __slots__ = ('name', 'function', 'call_interval', 'fixed_rate', 'last_invocation_time')
+
+    def __init__(self, name, function, call_interval, fixed_rate=False):
+        """Initialize a function record that was not invoked yet."""
+
+        self.name = name
+        self.function = function
+        self.call_interval = call_interval
+        self.fixed_rate = fixed_rate
+        self.last_invocation_time = 0.0
+
+    def __repr__(self):
+        return '{}: function {}, call interval {}{}, last invocation {}'.format(
+               self.name, self.function.__name__, self.call_interval, ' fixed rate' if self.fixed_rate else '',
+               self.last_invocation_time)
+
 class Dispatcher:
     """Dispatcher class, encapsulates automation and invocation of registered functions at defined time intervals."""
 
-    def __init__(self, param_init={}):
+    def __init__(self, param_init={}, time_source=time):
         """Initialize the dispatch table with the function identification and call interval."""
 
         self.shared_parameters = param_init
         self.dispatch_table = {}
+        self.tasks = []
+        self.time_source = time_source
 
-    def register(self, func_ref_name, function, call_interval):
-        """Register a function with the dispatcher instance."""
+    def register(self, func_ref_name, function, call_interval, fixed_rate=False):
+        """
+        Register a function with the dispatcher instance.
+        A 'fixed_rate' function's invocation times are kept at multiples of its interval,
+        and invocations missed by more than an interval are skipped.
+        """
+
+        self.unregister(func_ref_name)
+        task = _Task(func_ref_name, function, call_interval, fixed_rate)
+        self.dispatch_table[func_ref_name] = task
+        self.tasks.append(task)
 
-        temp_function_def = {"function":function, "call_interval":call_interval, "last_invocation_time":0.0}
-        self.dispatch_table[func_ref_name] = temp_function_def
+    def set_interval(self, func_ref_name, call_interval):
+        """Change the call interval of a registered function."""
+
+        if func_ref_name in self.dispatch_table:
+            self.dispatch_table[func_ref_name].call_interval = call_interval
 
     def unregister(self, func_ref_name):
         """Unregister and remove a function from the dispatcher list"""
 
-        if func_ref_name in self.__dispatch_table:
+        if func_ref_name in self.dispatch_table:
+            self.tasks.remove(self.dispatch_table[func_ref_name])
             del self.dispatch_table[func_ref_name]
 
     def show(self, func_ref_name=None):
         """Print out the registration information of a function."""
 
         if func_ref_name:
-            if func_ref_name in self.__dispatch_table:
+            if func_ref_name in self.dispatch_table:
                 print self.dispatch_table[func_ref_name]
             else:
                 print 'Function {} not registered.'.format(func_ref_name)
         else:
-            for name in self.dispatch_table:
-                print self.dispatch_table[name]
+            for task in self.tasks:
+                print task
 
     def dispatch(self):
         """
@@ -51,10 +90,17 @@ class Dispatcher:
         for example: if shortest invocation interval is 2sec, call dispatch() every 1sec or less.
         """
 
-        for function in self.dispatch_table:
-            self.function_param = self.dispatch_table[function]
-            self.time_now = time.time()
+        for task in self.tasks:
+            time_now = self.time_source.time()
+
+            if time_now - task.last_invocation_time >= task.call_interval - TIME_RESOLUTION:
+                if task.fixed_rate and time_now - task.last_invocation_time < 2 * task.call_interval:
+                    task.last_invocation_time += task.call_interval
+                else:
+                    task.last_invocation_time = time_now
+                task.function(self.shared_parameters)
+
+    def next_due(self):
+        """Return the time at which the next registered function is due to be invoked."""
 
-            if self.time_now - self.function_param['last_invocation_time'] >= self.function_param['call_interval']:
-                self.function_param['last_invocation_time'] = self.time_now
-                self.function_param['function'](self.shared_parameters)
+        return min([task.last_invocation_time + task.call_interval for task in self.tasks])
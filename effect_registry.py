@@ -0,0 +1,133 @@
+#
+# effect_registry.py
+#
+#   Effect registry module for Nixie Tube clock.
+#   Keeps the list of display effects configured in the <effects> block of clock.xml
+#   and runs them at their configured minute period.
+#   Effects are either built-in functions registered by the clock module, or plugin
+#   modules in the 'effects' package directory. Plugin modules are imported only when
+#   an effect is first scheduled to run, so unused effects cost no start-up time or memory.
+#
+#   A plugin module must define:
+#     FRAME_RATE            effect frames per second
+#     DURATION              effect run time in seconds
+#     run(digits, params)   run the effect, 'digits' are the digits to display when done,
+#                           'params' is the dictionary of the effect's XML attributes
+#   Plugins display frames through clock.effect_frame()
+#   An effect that fails to load or raises an exception while running is disabled,
+#   so that a faulty plugin does not stop the clock display.
+#   Effect runs are logged to an optional event log.
+#
+
+import spi_bus
+
+EFFECTS_PACKAGE = 'effects'
+SPI_BYTE_RATE = min(475.0, spi_bus.BYTE_BUDGET / spi_bus.TICK)  # SPI bytes per second at BCM2835_SPI_CLOCK_DIVIDER_65536,
+                                                                # limited by the SPI bus byte budget
+FRAME_BYTES = 12            # Brightness, four digits and watchdog 2-byte commands per frame
+MINUTE = 60.0
+
+class Effect(object):
+    """Effect definition with its declared frame rate and duration."""
+
+    __slots__ = ('name', 'function', 'frame_rate', 'duration')
+
+    def __init__(self, name, function, frame_rate, duration):
+        """Initialize an effect, 'function' is called with the final digits and effect parameters."""
+
+        self.name = name
+        self.function = function
+        self.frame_rate = frame_rate
+        self.duration = duration
+
+    def bus_time(self):
+        """Return the SPI bus time, in seconds, needed by the effect's frames."""
+
+        return self.frame_rate * self.duration * FRAME_BYTES / SPI_BYTE_RATE
+
+    def run_time(self):
+        """Return expected effect run time in seconds, the longer of its duration or its bus time."""
+
+        return max(self.duration, self.bus_time())
+
+class _ScheduleEntry(object):
+    """Configured effect, with its period, parameters and run lock."""
+
+    __slots__ = ('name', 'period', 'params', 'lock')
+
+    def __init__(self, name, params):
+        """Initialize an unlocked schedule entry."""
+
+        self.name = name
+        self.period = int(params.get('period', '0'))
+        self.params = params
+        self.lock = 0
+
+class EffectRegistry:
+    """Registry and scheduler of display effects."""
+
+    def __init__(self, package=EFFECTS_PACKAGE):
+        """Initialize an empty registry, plugins are imported from 'package'."""
+
+        self.package = package
+        self.effects = {}
+        self.schedule = []
+        self.event_log = None
+
+    def register(self, name, function, frame_rate, duration):
+        """Register a built-in effect function."""
+
+        self.effects[name] = Effect(name, function, frame_rate, duration)
+
+    def configure(self, effect_list):
+        """
+        Set the effect schedule from a list of (name, parameters) tuples.
+        The 'period' parameter is the effect's minute interval, '0' disables the effect.
+        """
+
+        self.schedule = [_ScheduleEntry(name, params) for name, params in effect_list]
+
+    def load(self, name):
+        """Return an effect by name, import its plugin module if it was not loaded yet."""
+
+        if name not in self.effects:
+            import importlib
+            plugin = importlib.import_module(self.package + '.' + name)
+            self.effects[name] = Effect(name, plugin.run, plugin.FRAME_RATE, plugin.DURATION)
+
+        return self.effects[name]
+
+    def lock(self):
+        """Prevent all effects from running in their current period."""
+
+        for entry in self.schedule:
+            entry.lock = 1
+
+    def run(self, t, digits=(0,0,0,0)):
+        """
+        Run effects that are due at time 't', a time.struct_time, once per period.
+        An effect is skipped for the period if its run time does not fit in the remainder
+        of the current minute, so that the minute display update is not delayed.
+        Effects that can not be loaded, or that raise an exception, are disabled.
+        """
+
+        time_budget = MINUTE - t.tm_sec
+
+        # TODO the lock will prohibit an effect from running on 1-min interval
+        for entry in self.schedule:
+            if entry.period > 0 and t.tm_min % entry.period == 0:
+                if entry.lock == 0:
+                    entry.lock = 1
+                    try:
+                        effect = self.load(entry.name)
+                        if effect.run_time() < time_budget:
+                            effect.function(digits, entry.params)
+                            time_budget -= effect.run_time()
+                            if self.event_log:
+                                self.event_log.log('effect', name=entry.name)
+                    except Exception as e:
+                        entry.period = 0
+                        if self.event_log:
+                            self.event_log.log('effect_disabled', name=entry.name, error=type(e).__name__)
+            else:
+                entry.lock = 0
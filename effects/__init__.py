@@ -0,0 +1,7 @@
+#
+# effects
+#
+#   Display effect plugins for Nixie Tube clock.
+#   Each module in this package is an effect that can be listed by module name
+#   in the <effects> block of clock.xml. See effect_registry.py for the plugin interface.
+#
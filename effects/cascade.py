@@ -0,0 +1,29 @@
+#
+# cascade.py
+#
+#   Cascade effect plugin for Nixie Tube clock.
+#   All tubes count down from '9', and each tube stops on its final digit,
+#   tens of hours first.
+#   Parameters: 'delay' frame time in seconds, default 0.1
+#
+
+import clock
+
+FRAME_RATE = 10.0
+DURATION = 1.9
+
+def run(digits=(0,0,0,0), params={}):
+    """Count all tubes down from '9' and stop each tube on its digit, left to right."""
+
+    delay = float(params.get('delay', '0.1'))
+    slots = [9,9,9,9]
+
+    for step in range(0,19):
+        for d in range(0,4):
+            n = 9 - step + (d * 3)
+            if n > 9:
+                n = 9
+            if n <= digits[d] or digits[d] > 9:
+                n = digits[d]
+            slots[d] = n
+        clock.effect_frame(slots, 10, delay)
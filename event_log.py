@@ -0,0 +1,176 @@
+#
+# event_log.py
+#
+#   Event log module for Nixie Tube clock.
+#   Clock events, such as watchdog failures, AVR resets, configuration reloads,
+#   effect runs and brightness changes, are logged into an in-memory ring buffer
+#   without any file access, so that logging never blocks the SPI path.
+#   The buffer is drained periodically, in one batch write, to a text log file that
+#   should be placed on tmpfs and is rotated when it reaches its maximum size.
+#   Optionally, a compacted copy of the tmpfs log is written periodically to persistent
+#   storage by a forked child process, so that slow SD card writes do not block the clock.
+#
+#   Log line format, one event per line:
+#   <time stamp> <event> [<key>=<value> ...]
+#
+#   In the compacted copy, a run of identical events is written as its first line
+#   with 'repeat=<count>' and 'last=<time stamp>' of the last event of the run.
+#
+
+import os
+import time
+from collections import deque
+
+EVENT_CAPACITY = 512        # Ring buffer events, the oldest events are dropped when full
+
+class EventLog:
+    """Ring buffered structured event log with batched writes to a rotating file."""
+
+    def __init__(self, capacity=EVENT_CAPACITY):
+        """Initialize an empty ring buffer, events are not written until a log file is configured."""
+
+        self.events = deque(maxlen=capacity)
+        self.dropped = 0
+        self.counts = {}
+        self.time_source = time
+
+        self.file_name = None
+        self.max_size = 0
+        self.log_file = None
+        self.log_size = 0
+
+        self.persist_file = None
+        self.persist_pid = 0
+
+    def log(self, event, **fields):
+        """Buffer an event with its 'key=value' fields, never blocks."""
+
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append((self.time_source.time(), event, fields))
+        self.counts[event] = self.counts.get(event, 0) + 1
+
+    def configure(self, file_name=None, max_size=262144, persist_file=None):
+        """
+        Set the tmpfs log file and its maximum size in bytes, and the persistent storage file
+        for compacted copies. A 'file_name' of None discards drained events.
+        """
+
+        if file_name != self.file_name:
+            self.close()
+            self.file_name = file_name
+            if file_name:
+                self.log_file = open(file_name, 'a')
+                self.log_size = os.path.getsize(file_name)
+
+        self.max_size = max_size
+        self.persist_file = persist_file
+
+    def drain(self):
+        """Write buffered events to the log file in one batch, rotate the file if it reached its maximum size."""
+
+        if not self.events:
+            return
+
+        lines = []
+        while self.events:
+            time_stamp, event, fields = self.events.popleft()
+            lines.append(_format(time_stamp, event, fields))
+
+        if self.dropped:
+            lines.append(_format(self.time_source.time(), 'events_dropped', {'count':self.dropped}))
+            self.dropped = 0
+
+        if not self.log_file:
+            return
+
+        batch = ''.join(lines)
+        if self.log_size + len(batch) > self.max_size:
+            self.log_file.close()
+            os.rename(self.file_name, self.file_name + '.1')
+            self.log_file = open(self.file_name, 'a')
+            self.log_size = 0
+
+        self.log_file.write(batch)
+        self.log_file.flush()
+        self.log_size += len(batch)
+
+    def persist(self):
+        """
+        Write a compacted copy of the tmpfs log files to the persistent storage file.
+        The copy is written by a forked child process, and is skipped if the previous
+        copy is still being written. Returns True if a copy was started.
+        """
+
+        if not self.persist_file or not self.log_file:
+            return False
+
+        if self.persist_pid:
+            pid, status = os.waitpid(self.persist_pid, os.WNOHANG)
+            if pid == 0:
+                return False
+            self.persist_pid = 0
+
+        self.drain()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self._write_compacted()
+            finally:
+                os._exit(0)
+
+        self.persist_pid = pid
+        return True
+
+    def close(self):
+        """Drain remaining events and close the log file."""
+
+        self.drain()
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+        self.file_name = None
+
+    def _write_compacted(self):
+        """Compact runs of identical events from the rotated and current log files into the persistent file."""
+
+        temp_file = self.persist_file + '.tmp'
+        out = open(temp_file, 'w')
+
+        run = None
+        count = 0
+        last = None
+        for file_name in (self.file_name + '.1', self.file_name):
+            if not os.path.isfile(file_name):
+                continue
+            for line in open(file_name):
+                time_stamp, sep, event = line.rstrip('\n').partition(' ')
+                if event == run:
+                    count += 1
+                    last = time_stamp
+                    continue
+                if run is not None:
+                    _write_run(out, first, run, count, last)
+                first, run, count, last = time_stamp, event, 1, time_stamp
+
+        if run is not None:
+            _write_run(out, first, run, count, last)
+
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+        os.rename(temp_file, self.persist_file)
+
+def _format(time_stamp, event, fields):
+    """Return an event log line."""
+
+    return '{:.3f} {}{}\n'.format(time_stamp, event, ''.join([' {}={}'.format(key, fields[key]) for key in sorted(fields)]))
+
+def _write_run(out, first, event, count, last):
+    """Write a compacted run of 'count' identical events."""
+
+    if count == 1:
+        out.write('{} {}\n'.format(first, event))
+    else:
+        out.write('{} {} repeat={} last={}\n'.format(first, event, count, last))
@@ -0,0 +1,115 @@
+#
+# link_recovery.py
+#
+#   SPI link recovery module for Nixie Tube clock.
+#   A watchdog reply other than 170 is handled in stages, from the least to the most
+#   disruptive, instead of an immediate AVR reset:
+#   1. Re-sync: send a single dummy byte to realign the AVR's 2-byte command framing,
+#      then retry the watchdog command. Two attempts cover both framing alignments.
+#   2. Probe: read the firmware version to check if the AVR is alive, the version must
+#      be the negotiated version and be followed by a valid watchdog reply, because a
+#      hung AVR echoes the command byte.
+#   3. Reset: reset the AVR through GPIO, with exponential back-off between failed resets.
+#   After recovery the display state is restored immediately. Failure counts and
+#   recovery times are kept for diagnostics.
+#
+
+import time
+
+SPI_CMD_GET_VER = 7
+SPI_CMD_WDOG = 85
+WATCH_DOG_REPLY = 170
+DUMMY = 255
+
+RESYNC_ATTEMPTS = 2
+RESET_BACKOFF = 1.0         # First back-off time in seconds after a failed AVR reset
+RESET_BACKOFF_MAX = 60.0
+
+LINK_UP = 'up'
+LINK_DOWN = 'down'
+
+STAGE_RETRY = 'retry'
+STAGE_RESYNC = 'resync'
+STAGE_PROBE = 'probe'
+STAGE_RESET = 'reset'
+
+class LinkRecovery:
+    """Staged SPI link recovery state machine."""
+
+    def __init__(self, transfer, command, reset, restore):
+        """
+        Initialize link state. The functions passed in are used to access the AVR:
+        'transfer(byte)' single byte SPI transfer, 'command(cmd, byte)' 2-byte SPI command,
+        'reset()' AVR hardware reset, and 'restore()' to resend the full display state.
+        """
+
+        self.transfer = transfer
+        self.command = command
+        self.reset = reset
+        self.restore = restore
+        self.time_source = time
+        self.firmware_version = None    # Negotiated firmware version, set by the clock module
+
+        self.state = LINK_UP
+        self.failures = 0
+        self.failed_resets = 0
+        self.recoveries = {STAGE_RETRY:0, STAGE_RESYNC:0, STAGE_PROBE:0, STAGE_RESET:0}
+        self.failure_time = 0.0
+        self.last_recovery_time = 0.0
+        self.max_recovery_time = 0.0
+        self.backoff = RESET_BACKOFF
+        self.next_reset = 0.0
+
+    def check(self, reply):
+        """
+        Check a watchdog command reply and run link recovery if it is wrong.
+        Return the recovery stage that restored the link, or None if no recovery was needed
+        or the link is still down.
+        """
+
+        if reply == WATCH_DOG_REPLY:
+            if self.state == LINK_UP:
+                return None
+            stage = STAGE_RETRY
+        else:
+            if self.state == LINK_UP:
+                self.state = LINK_DOWN
+                self.failures += 1
+                self.failure_time = self.time_source.time()
+            stage = self._recover()
+            if stage is None:
+                return None
+
+        self.state = LINK_UP
+        self.recoveries[stage] += 1
+        self.last_recovery_time = self.time_source.time() - self.failure_time
+        self.max_recovery_time = max(self.max_recovery_time, self.last_recovery_time)
+        self.backoff = RESET_BACKOFF
+        self.next_reset = 0.0
+        self.restore()
+
+        return stage
+
+    def _recover(self):
+        """Run recovery stages, return the stage that restored the link or None."""
+
+        for attempt in range(0,RESYNC_ATTEMPTS):
+            self.transfer(DUMMY)
+            if self.command(SPI_CMD_WDOG) == WATCH_DOG_REPLY:
+                return STAGE_RESYNC
+
+        # The negotiated version and a valid watchdog reply mean the AVR is alive
+        version = self.command(SPI_CMD_GET_VER)
+        if version == self.firmware_version and self.command(SPI_CMD_WDOG) == WATCH_DOG_REPLY:
+            return STAGE_PROBE
+
+        time_now = self.time_source.time()
+        if time_now >= self.next_reset:
+            self.reset()
+            if self.command(SPI_CMD_WDOG) == WATCH_DOG_REPLY:
+                return STAGE_RESET
+            self.failed_resets += 1
+            self.next_reset = time_now + self.backoff
+            self.backoff = min(self.backoff * 2, RESET_BACKOFF_MAX)
+
+        return None
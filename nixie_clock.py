@@ -10,9 +10,11 @@
 #
 
 import sys
+import libbcm2835._bcm2835 as soc
 import dispatcher as dsp
 
-from clock import initialize, watchdog, time_display
+from clock import initialize, watchdog, time_display, wear_persist, spi_record, log_events
+from clock import mode_display, frame_interval, spi_flush, flush_interval
 from configuration import get_clock_config
 
 parameter_init = {'config_file_last_mod':0.0, 'config_change':'no'}
@@ -20,7 +22,10 @@ parameter_init = {'config_file_last_mod':0.0, 'config_change':'no'}
 def main():
     """Initialize GPIO and SPI and start clock functions."""
 
-    if initialize() == 0:
+    # Read configuration before initialization for the firmware version check
+    get_clock_config(parameter_init)
+
+    if initialize(parameter_init) == 0:
         soc.bcm2835_close()
         sys.exit(1) 
 
@@ -28,12 +33,19 @@ def main():
 
     clock_driver.register('watchdog', watchdog, 4)
     clock_driver.register('time_display', time_display, 1)
-    clock_driver.register('configuration', get_clock_config, 600)
+    clock_driver.register('configuration', get_clock_config, 60)
+    clock_driver.register('cathode_wear', wear_persist, 900)
+    clock_driver.register('spi_recorder', spi_record, 5)
+    clock_driver.register('event_log', log_events, 5)
+    clock_driver.register('mode_display', mode_display, frame_interval(), fixed_rate=True)
+    clock_driver.register('spi_flush', spi_flush, flush_interval())
 
     #clock_driver.show()
 
     while True:
         clock_driver.dispatch()
+        clock_driver.set_interval('mode_display', frame_interval())
+        clock_driver.set_interval('spi_flush', flush_interval())
 
     # Will not get here ever
     soc.bcm2835_close()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+#
+# nixie_sim.py
+#
+#   Nixie Tube clock simulation in virtual time.
+#   Runs the clock module and dispatcher, with the same registered functions as
+#   nixie_clock.py, against the simulated AVR controller in avr_model.py. Virtual time
+#   advances only by dispatcher wait times and SPI byte times, so a day of clock
+#   operation runs in seconds. Used to soak-test changes for display off periods,
+#   top of hour date display, effect cadence and DST changes, and to measure
+#   SPI traffic and CPU cost per day.
+#
+#   usage: nixie_sim.py [-h] [--start 'YYYY-MM-DD HH:MM'] [--days DAYS] [--tz TZ]
+#                       [--firmware VERSION] [--record FILE] [--view]
+#                       [--mode MODE] [--frame-rate RATE] [--avr-drift PPM]
+#
+
+import os
+import sys
+import math
+import time
+import shutil
+import argparse
+import tempfile
+
+import avr_model
+import clock
+import spi_bus
+import dispatcher as dsp
+
+from virtual_time import VirtualTime
+from configuration import get_clock_config
+
+SECONDS_PER_DAY = 86400.0
+
+def main():
+    """Run the clock in virtual time and print a traffic and cost summary."""
+
+    parser = argparse.ArgumentParser(description='Nixie Tube clock simulation in virtual time.')
+    parser.add_argument('--start', help="virtual start time 'YYYY-MM-DD HH:MM', default is now")
+    parser.add_argument('--days', type=float, default=1.0, help='virtual days to run, default 1')
+    parser.add_argument('--tz', help="time zone, for example 'Europe/London', default is the system time zone")
+    parser.add_argument('--firmware', default='1.3', help="simulated AVR firmware version, default '1.3'")
+    parser.add_argument('--record', help='record SPI transactions to FILE, with virtual time stamps')
+    parser.add_argument('--view', action='store_true', help='print tube display changes')
+    parser.add_argument('--mode', help="display mode 'time', 'seconds', 'stopwatch' or 'countdown', default from clock.xml")
+    parser.add_argument('--frame-rate', type=float, help='high-refresh display mode frame rate, default from clock.xml')
+    parser.add_argument('--avr-drift', type=float, default=0.0, help='AVR oscillator error in parts per million, default 0')
+    args = parser.parse_args()
+
+    if args.tz:
+        os.environ['TZ'] = args.tz
+        time.tzset()
+
+    start = None
+    if args.start:
+        start = time.mktime(time.strptime(args.start, '%Y-%m-%d %H:%M'))
+
+    virtual_time = VirtualTime(start)
+    version = (int(args.firmware.split('.')[0]) << 4) + int(args.firmware.split('.')[1])
+    model = avr_model.AvrModel(version=version, drift_ppm=args.avr_drift)
+    bus = avr_model.SimulatedBcm2835(model, virtual_time)
+    if args.view:
+        bus.on_transfer = _view
+
+    temp_dir = tempfile.mkdtemp()
+    param = {'config_file_last_mod':0.0, 'config_change':'no', 'wear_file':os.path.join(temp_dir, 'cathode_wear.dat')}
+    get_clock_config(param)
+    param['event_log_file'] = os.path.join(temp_dir, 'nixie-events.log')
+    param['event_log_persist_file'] = ''
+    if args.mode:
+        param['display_mode'] = args.mode
+    if args.frame_rate:
+        param['frame_rate'] = str(args.frame_rate)
+    if args.record:
+        param['spi_recorder'] = 'yes'
+        param['spi_recorder_file'] = args.record
+    else:
+        param['spi_recorder'] = 'no'
+
+    clock.soc = bus
+    clock.set_time_source(virtual_time)
+
+    if clock.initialize(param) == 0:
+        print('clock initialization failed, firmware {}'.format(clock.firmware_info()))
+        sys.exit(1)
+
+    clock_driver = dsp.Dispatcher(param, virtual_time)
+
+    clock_driver.register('watchdog', clock.watchdog, 4)
+    clock_driver.register('time_display', clock.time_display, 1)
+    clock_driver.register('configuration', get_clock_config, 60)
+    clock_driver.register('cathode_wear', clock.wear_persist, 900)
+    clock_driver.register('spi_recorder', clock.spi_record, 5)
+    clock_driver.register('event_log', clock.log_events, 5)
+    clock_driver.register('mode_display', clock.mode_display, clock.frame_interval(), fixed_rate=True)
+    clock_driver.register('spi_flush', clock.spi_flush, clock.flush_interval())
+
+    cpu_start = sum(os.times()[0:2])
+    real_start = time.time()
+    virtual_start = virtual_time.time()
+    virtual_end = virtual_start + args.days * SECONDS_PER_DAY
+
+    while virtual_time.time() < virtual_end:
+        model.light_sensor = _daylight(virtual_time.localtime())
+        clock_driver.dispatch()
+        clock_driver.set_interval('mode_display', clock.frame_interval())
+        clock_driver.set_interval('spi_flush', clock.flush_interval())
+        virtual_time.sleep(clock_driver.next_due() - virtual_time.time())
+        bus.sync()
+
+    clock.spi_record({})
+    clock.events.close()
+    clock.wear.close()
+    shutil.rmtree(temp_dir)
+
+    days = (virtual_time.time() - virtual_start) / SECONDS_PER_DAY
+    cpu = sum(os.times()[0:2]) - cpu_start
+
+    print('simulated {:.2f} days from {} in {:.1f}[sec], CPU {:.1f}[sec] ({:.2f}[sec] per day)'.format(
+        days, time.strftime('%Y-%m-%d %H:%M %Z', time.localtime(virtual_start)), time.time() - real_start, cpu, cpu / days))
+    print('firmware {}'.format(clock.firmware_info()))
+    print('SPI bytes: {} ({:.0f} per day)'.format(bus.bytes_transferred, bus.bytes_transferred / days))
+    for command in sorted(bus.commands):
+        print('  command {:3d}: {:.0f} per day'.format(command, bus.commands[command] / days))
+    print('AVR watchdog expiries: {}, link failures: {}, recoveries: {}'.format(
+        model.watch_dog_expiries, clock.link.failures, clock.link.recoveries))
+
+    mode = clock.mode_info()
+    if mode['mode'] != 'time':
+        print('display mode {}: {} frames at {:.2f} per second, target {:.1f}, dropped {}, jitter avg {:.1f}[mSec] max {:.1f}[mSec]'.format(
+              mode['mode'], mode['frames'], mode['achieved_rate'], mode['frame_rate'], mode['dropped'],
+              mode['jitter_avg'] * 1000.0, mode['jitter_max'] * 1000.0))
+    timekeeping = clock.time_info()
+    if timekeeping['enabled']:
+        print('AVR time keeping: syncs {}, time steps {}, last drift {}[sec] in {:.0f}[sec], AVR clock {:02d}:{:02d}:{:02d}'.format(
+              timekeeping['syncs'], timekeeping['steps'], timekeeping['drift'], timekeeping['drift_interval'], *model.clock()))
+    print('events: {}'.format(', '.join(['{} {}'.format(event, clock.events.counts[event]) for event in sorted(clock.events.counts)])))
+
+    bus_stats = clock.bus_info()
+    print('SPI bus queue: max depth {}, coalesced writes {}, deferred flushes {}'.format(
+        bus_stats['max_depth'], bus_stats['coalesced'], bus_stats['deferred']))
+    for name in spi_bus.PRIORITY_NAMES:
+        p = bus_stats['priorities'][name]
+        print('  {:10s}: commands {}, writes {}, wait avg {:.1f}[mSec] max {:.1f}[mSec]'.format(
+            name, p['commands'], p['writes'], p['wait_avg'] * 1000.0, p['wait_max'] * 1000.0))
+
+def _daylight(t):
+    """Simulated light sensor reading for local time 't', dark at night and brightest at noon."""
+
+    hour = t.tm_hour + t.tm_min / 60.0
+    return 10 + int(230 * max(math.sin(math.pi * (hour - 6.0) / 12.0), 0.0))
+
+_last_view = None
+
+def _view(bus):
+    """Print the tubes when the displayed digits, brightness or high voltage change."""
+
+    global _last_view
+
+    model = bus.model
+    view = (model.display(), model.brightness_level, model.high_voltage())
+    if view != _last_view:
+        _last_view = view
+        tubes = ''.join(['[{}]'.format(d if d <= 9 else ' ') for d in view[0]])
+        print('{} {}:{} brightness {:2d} {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', bus.time_source.localtime()),
+              tubes[0:6], tubes[6:12], view[1], 'HV on' if view[2] else 'HV off'))
+
+#
+# Startup
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+###############################################################################
+#
+# spi-replay.py
+#
+#   Replay a binary SPI transaction log, recorded by the clock's SPI recorder,
+#   into the simulated AVR model (avr_model.py).
+#   Replies from the model are compared to the recorded replies, and any
+#   mismatch is printed with its time stamp. A traffic summary is printed at the end.
+#   The model starts from the AVR state records at the start of the log, or as
+#   the firmware version of the '--firmware' option in its power-on state for logs
+#   without state records.
+#
+#   usage: spi-replay.py [--firmware VERSION] <log file> [speed]
+#          VERSION: AVR firmware version of a log without state records, default '1.3'
+#          speed: '1' replays at original speed, '10' is 10 times faster,
+#                 '0' (default) replays as fast as possible
+#
+###############################################################################
+
+import sys
+import time
+
+import avr_model
+from spi_recorder import read_log, RECORD_AVR_RESET, RECORD_SINGLE_BYTE, RECORD_STATE
+
+def main():
+    """Replay an SPI log into the AVR model and print a summary."""
+
+    args = sys.argv[1:]
+    version = avr_model.VERSION
+    if args and args[0] == '--firmware' and len(args) > 1:
+        version = (int(args[1].split('.')[0]) << 4) + int(args[1].split('.')[1])
+        args = args[2:]
+
+    if len(args) < 1:
+        print('usage: spi-replay.py [--firmware VERSION] <log file> [speed]')
+        sys.exit(1)
+
+    speed = 0.0
+    if len(args) > 1:
+        speed = float(args[1])
+
+    model = avr_model.AvrModel(version=version)
+    command_count = {}
+    transactions = 0
+    byte_count = 0
+    mismatches = 0
+    resets = 0
+    states = 0
+    first_time_stamp = None
+    last_time_stamp = None
+    model_time = None
+    replay_start = time.time()
+
+    for time_stamp, command, sent, reply in read_log(args[0]):
+
+        if last_time_stamp is None:
+            first_time_stamp = time_stamp
+            model_time = time_stamp
+        elif speed > 0:
+            time.sleep(max(time_stamp - last_time_stamp, 0.0) / speed)
+        last_time_stamp = time_stamp
+
+        # Records are time stamped after their last byte, the AVR processes each byte at the end of its byte time
+        if command in (RECORD_AVR_RESET, RECORD_SINGLE_BYTE, RECORD_STATE):
+            model_time = _advance(model, model_time, time_stamp)
+        else:
+            model_time = _advance(model, model_time, time_stamp - avr_model.SPI_BYTE_TIME)
+
+        if command == RECORD_AVR_RESET:
+            print('{:.3f} AVR reset, display was {}'.format(time_stamp, model.display()))
+            model.reset()
+            resets += 1
+            continue
+
+        # State records start a new model, and set its registers with SPI writes
+        if command == RECORD_STATE:
+            if sent == avr_model.SPI_CMD_GET_VER:
+                model = avr_model.AvrModel(version=reply)
+                model_time = time_stamp
+                states += 1
+            else:
+                model.transfer(sent)
+                model.transfer(reply)
+            continue
+
+        # Light sensor input is not modeled, take it from the log
+        if command == avr_model.SPI_CMD_GET_LIGHT:
+            model.light_sensor = reply
+
+        if command == RECORD_SINGLE_BYTE:
+            model_reply = model.transfer(sent)
+            byte_count += 1
+        else:
+            model.transfer(command)
+            model_time = _advance(model, model_time, time_stamp)
+            model_reply = model.transfer(sent)
+            byte_count += 2
+
+        transactions += 1
+        command_count[command] = command_count.get(command, 0) + 1
+
+        if model_reply != reply:
+            mismatches += 1
+            print('{:.3f} command {} sent {} replied {} model replied {}'.format(time_stamp, command, sent, reply, model_reply))
+
+    print('transactions: {}, bytes: {}, AVR resets: {}, AVR states: {}, mismatches: {}'.format(
+          transactions, byte_count, resets, states, mismatches))
+    for command in sorted(command_count):
+        print('  command {:3d}: {}'.format(command, command_count[command]))
+    if first_time_stamp is not None:
+        print('log duration: {:.3f}[sec], replay time: {:.3f}[sec]'.format(last_time_stamp - first_time_stamp, time.time() - replay_start))
+    print('final display: {}, high voltage: {}'.format(model.display(), model.high_voltage()))
+
+def _advance(model, model_time, time_stamp):
+    """Advance the model's timer from 'model_time' to 'time_stamp', if it is later, and return the model time."""
+
+    if time_stamp > model_time:
+        model.tick(time_stamp - model_time)
+        return time_stamp
+
+    return model_time
+
+###############################################################################
+#
+# Startup
+#
+if __name__ == '__main__':
+    main()
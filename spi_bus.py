@@ -0,0 +1,221 @@
+#
+# spi_bus.py
+#
+#   SPI bus arbiter for Nixie Tube clock.
+#   All SPI commands to the AVR go through one SpiBus object.
+#   Writes that need no reply are queued by priority: keep-alive, link recovery,
+#   time digits, brightness, and effects. A queued write to a register that
+#   already has a pending write replaces it, so only the latest value is sent.
+#   Commands that write several registers, such as a packed digit pair, are mapped
+#   to their registers: a write drops the pending writes it fully overwrites, and a
+#   pending write that it overwrites in part is sent first.
+#   Queued writes are sent in priority order within a byte budget per tick, writes
+#   over the budget wait for the next tick, which bounds the time the bus is held
+#   by effect bursts. The bus owner calls flush() at next_tick() while writes are
+#   queued. Commands that need a reply are sent immediately, after the queued writes
+#   of the same or higher priority. A command replaces a queued write to the same
+#   register, and the write's callback is called with the command's reply.
+#   Queue depth, coalesced writes and queue wait times are kept for diagnostics.
+#
+
+import time
+
+PRIORITY_KEEP_ALIVE = 0
+PRIORITY_RECOVERY = 1
+PRIORITY_TIME = 2
+PRIORITY_BRIGHTNESS = 3
+PRIORITY_EFFECT = 4
+PRIORITY_NAMES = ('keep_alive', 'recovery', 'time', 'brightness', 'effect')
+
+DUMMY = 255
+COMMAND_BYTES = 2
+TICK = 0.1                  # Byte budget period in seconds
+BYTE_BUDGET = 24            # Queued write bytes per tick, half of the bus at 475 bytes per second
+
+class _Write(object):
+    """Queued SPI write."""
+
+    __slots__ = ('priority', 'command', 'data', 'done', 'queue_time')
+
+    def __init__(self, priority, command, data, done, queue_time):
+        """Initialize a queued write, 'done(command, data, reply)' is called after it is sent."""
+
+        self.priority = priority
+        self.command = command
+        self.data = data
+        self.done = done
+        self.queue_time = queue_time
+
+class SpiBus:
+    """Priority SPI bus arbiter with write coalescing and a per-tick byte budget."""
+
+    def __init__(self, transfer, byte_budget=BYTE_BUDGET, tick=TICK, registers=None):
+        """
+        Initialize empty queues, 'transfer(command, data)' sends a 2-byte SPI command
+        and returns the AVR's response to the second byte. 'registers' maps commands
+        that share AVR registers to the tuple of registers they write, other commands
+        write their own register.
+        """
+
+        self.transfer = transfer
+        self.registers = registers or {}
+        self.byte_budget = byte_budget
+        self.tick = tick
+        self.time_source = time
+
+        self.queues = [[] for name in PRIORITY_NAMES]
+        self.pending = {}
+        self.tick_start = 0.0
+        self.tick_bytes = 0
+
+        self.commands = [0] * len(PRIORITY_NAMES)
+        self.writes = [0] * len(PRIORITY_NAMES)
+        self.wait_total = [0.0] * len(PRIORITY_NAMES)
+        self.wait_max = [0.0] * len(PRIORITY_NAMES)
+        self.max_depth = 0
+        self.coalesced = 0
+        self.deferred = 0
+
+    def write(self, priority, command, data, done=None):
+        """
+        Queue a write of 'data' to the AVR register of 'command'.
+        A pending write to the same register is replaced by this one, it keeps
+        its queue time and takes the higher of the two priorities. Pending writes of
+        other commands to registers of this command are dropped if this write overwrites
+        all of their registers, or else take this write's priority and are sent before it.
+        """
+
+        entry = self.pending.get(command)
+        if entry:
+            self.queues[entry.priority].remove(entry)
+            entry.priority = min(entry.priority, priority)
+            entry.data = data
+            entry.done = done
+            self.coalesced += 1
+        else:
+            entry = _Write(priority, command, data, done, self.time_source.time())
+            self.pending[command] = entry
+
+        for other in self._overlapping(command):
+            self.queues[other.priority].remove(other)
+            if self._overwrites(command, other.command):
+                del self.pending[other.command]
+                self.coalesced += 1
+            else:
+                other.priority = min(other.priority, entry.priority)
+                self.queues[other.priority].append(other)
+
+        self.queues[entry.priority].append(entry)
+        self.max_depth = max(self.max_depth, len(self.pending))
+
+    def command(self, priority, command, data=DUMMY):
+        """
+        Send a command now and return the AVR's response.
+        Queued writes of the same or higher priority are sent first, and a queued
+        write to the same register is replaced by this command. The replaced write's
+        'done' callback is called with this command's data and reply, as if it was sent.
+        Queued writes of other commands to registers of this command are dropped if
+        this command overwrites all of their registers, or else are sent first.
+        """
+
+        self.flush(priority)
+
+        for other in self._overlapping(command):
+            self.queues[other.priority].remove(other)
+            del self.pending[other.command]
+            if self._overwrites(command, other.command):
+                self.coalesced += 1
+            else:
+                self._send(other)
+
+        entry = self.pending.pop(command, None)
+        if entry:
+            self.queues[entry.priority].remove(entry)
+            self.coalesced += 1
+
+        self.commands[priority] += 1
+        self.tick_bytes += COMMAND_BYTES
+
+        reply = self.transfer(command, data)
+        if entry and entry.done:
+            entry.done(command, data, reply)
+
+        return reply
+
+    def flush(self, priority=PRIORITY_EFFECT):
+        """
+        Send queued writes of 'priority' and higher in priority order, within the
+        byte budget of the current tick. Return the number of writes still queued.
+        """
+
+        time_now = self.time_source.time()
+        if time_now >= self.next_tick():
+            self.tick_start = time_now
+            self.tick_bytes = 0
+
+        for p in range(0, priority + 1):
+            queue = self.queues[p]
+            while queue and self.tick_bytes + COMMAND_BYTES <= self.byte_budget:
+                entry = queue.pop(0)
+                del self.pending[entry.command]
+                self._send(entry)
+
+        if self.pending:
+            self.deferred += 1
+
+        return len(self.pending)
+
+    def next_tick(self):
+        """Return the time at which the byte budget of the next tick is available."""
+
+        return self.tick_start + self.tick
+
+    def depth(self):
+        """Return the number of queued writes."""
+
+        return len(self.pending)
+
+    def _send(self, entry):
+        """Send a write taken off its queue, and call its 'done' callback with the AVR's response."""
+
+        p = entry.priority
+        wait = self.time_source.time() - entry.queue_time
+        self.wait_total[p] += wait
+        self.wait_max[p] = max(self.wait_max[p], wait)
+        self.writes[p] += 1
+        self.tick_bytes += COMMAND_BYTES
+
+        reply = self.transfer(entry.command, entry.data)
+        if entry.done:
+            entry.done(entry.command, entry.data, reply)
+
+    def _overlapping(self, command):
+        """Return the queued writes of other commands that write a register of 'command'."""
+
+        registers = set(self.registers.get(command, ()))
+        if not registers:
+            return []
+
+        return [entry for entry in self.pending.values()
+                if entry.command != command and registers & set(self.registers.get(entry.command, ()))]
+
+    def _overwrites(self, command, other_command):
+        """Return True if 'command' writes all the registers of 'other_command'."""
+
+        return set(self.registers[other_command]) <= set(self.registers[command])
+
+    def stats(self):
+        """
+        Return queue depth, coalesced writes and deferred flush counts, and per priority
+        counts of immediate commands, sent writes and their queue wait times in seconds.
+        """
+
+        priorities = {}
+        for p, name in enumerate(PRIORITY_NAMES):
+            writes = self.writes[p]
+            priorities[name] = {'depth':len(self.queues[p]), 'commands':self.commands[p], 'writes':writes,
+                                'wait_avg':self.wait_total[p] / writes if writes else 0.0,
+                                'wait_max':self.wait_max[p]}
+
+        return {'depth':len(self.pending), 'max_depth':self.max_depth, 'coalesced':self.coalesced,
+                'deferred':self.deferred, 'priorities':priorities}
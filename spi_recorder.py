@@ -0,0 +1,117 @@
+#
+# spi_recorder.py
+#
+#   SPI transaction recorder module for Nixie Tube clock.
+#   Records every 2-byte SPI command sent to the AVR into a compact, append-only,
+#   binary log file. Records are buffered in memory and written in batches so that
+#   recording does not stall the SPI path. The log file should be placed on tmpfs
+#   and is rotated when it reaches its maximum size.
+#
+#   Record format, little-endian, 11 bytes:
+#   | time stamp (double) | command (byte) | sent byte (byte) | reply byte (byte) |
+#
+#   A record with command RECORD_AVR_RESET marks an AVR reset through GPIO.
+#   A record with command RECORD_SINGLE_BYTE is a single byte transfer used for
+#   re-syncing the 2-byte command framing; its sent and reply bytes are valid.
+#   Records with command RECORD_STATE hold the AVR state at the start of each log
+#   file, from the recorder's 'state_source': the sent byte is the SPI command of an
+#   AVR register and the reply byte is its value, SPI_CMD_GET_VER is the firmware
+#   version and comes first. A replay starts its AVR model from these records.
+#
+
+import os
+import time
+import struct
+
+RECORD_FORMAT = '<dBBB'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+RECORD_AVR_RESET = 0        # Not a valid SPI command, used to mark AVR resets
+RECORD_SINGLE_BYTE = 254    # Not a valid SPI command, used to mark single byte transfers
+RECORD_STATE = 253          # Not a valid SPI command, used to mark AVR state records
+
+class SpiRecorder:
+    """Buffered binary SPI transaction log writer with file rotation."""
+
+    def __init__(self, file_name, max_size=1048576, batch_size=256):
+        """Open the log file for append. 'max_size' is in bytes and 'batch_size' in records."""
+
+        self.file_name = file_name
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.buffer = bytearray()
+        self.buffered = 0
+        self.time_source = time
+        self.state_source = None
+        self.log_file = open(file_name, 'ab')
+        self.log_size = os.path.getsize(file_name)
+
+    def record(self, command, sent, reply):
+        """Buffer one SPI transaction, and write the buffer to the log file when the batch is full."""
+
+        self.buffer += struct.pack(RECORD_FORMAT, self.time_source.time(), command & 0xff, sent & 0xff, reply & 0xff)
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def record_avr_reset(self):
+        """Buffer an AVR reset marker record."""
+
+        self.record(RECORD_AVR_RESET, 0, 0)
+
+    def record_byte(self, sent, reply):
+        """Buffer a single byte transfer record."""
+
+        self.record(RECORD_SINGLE_BYTE, sent, reply)
+
+    def record_state(self):
+        """
+        Buffer AVR state records from 'state_source', a function that returns the records'
+        time stamp and a list of (register command, value) tuples, if a state source is set.
+        """
+
+        if not self.state_source:
+            return
+
+        time_stamp, registers = self.state_source()
+        for register, value in registers:
+            self.buffer += struct.pack(RECORD_FORMAT, time_stamp, RECORD_STATE, register & 0xff, value & 0xff)
+            self.buffered += 1
+
+    def flush(self):
+        """
+        Write buffered records to the log file, rotate the file if it reached its maximum size.
+        A new file starts with AVR state records.
+        """
+
+        if self.buffered == 0:
+            return
+
+        self.log_file.write(self.buffer)
+        self.log_file.flush()
+        self.log_size += len(self.buffer)
+        self.buffer = bytearray()
+        self.buffered = 0
+
+        if self.log_size >= self.max_size:
+            self.log_file.close()
+            os.rename(self.file_name, self.file_name + '.1')
+            self.log_file = open(self.file_name, 'ab')
+            self.log_size = 0
+            self.record_state()
+
+    def close(self):
+        """Flush remaining records and close the log file."""
+
+        self.flush()
+        self.log_file.close()
+
+def read_log(file_name):
+    """Generator that returns SPI log records as (time stamp, command, sent, reply) tuples."""
+
+    log_file = open(file_name, 'rb')
+    while True:
+        record = log_file.read(RECORD_SIZE)
+        if len(record) < RECORD_SIZE:
+            break
+        yield struct.unpack(RECORD_FORMAT, record)
+    log_file.close()
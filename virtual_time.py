@@ -0,0 +1,39 @@
+#
+# virtual_time.py
+#
+#   Virtual time source for Nixie Tube clock simulation.
+#   Provides the time(), localtime() and sleep() functions of the 'time' module
+#   over a virtual clock that only advances when sleep() is called, so that the
+#   clock software can be run through hours or days in seconds.
+#   Local time conversion, including DST, follows the process time zone.
+#
+
+import time
+
+class VirtualTime:
+    """Virtual clock with the same interface as the 'time' module functions used by the clock."""
+
+    def __init__(self, start=None):
+        """Start virtual time at 'start' seconds since the epoch, or at the current time."""
+
+        if start is None:
+            start = time.time()
+        self.now = float(start)
+
+    def time(self):
+        """Return virtual time in seconds since the epoch."""
+
+        return self.now
+
+    def localtime(self, seconds=None):
+        """Return virtual local time as a time.struct_time."""
+
+        if seconds is None:
+            seconds = self.now
+        return time.localtime(seconds)
+
+    def sleep(self, seconds):
+        """Advance virtual time by 'seconds' without waiting."""
+
+        if seconds > 0:
+            self.now += seconds